@@ -0,0 +1,138 @@
+import argparse
+import math
+import time
+from src.config import *
+from src.devices import *
+from src.model import *
+from src.type import *
+
+## Compares the vectorized tile search of xPU with the loops it replaced and
+## reports the speedup, tests/test_tile_search.py checks that both find the
+## same tiles.
+
+# (batch, lin, lout)
+POINTS = [(1, 128, 128), (16, 2048, 1024), (256, 2048, 128), (64, 8192, 2)]
+
+
+def reference_tile(device, type, m, n, k, numOp, dbyte):
+    # the nested loops of xPU._get_optimal_tile before vectorization
+    def traffic(tm, tn):
+        return sum(device._tile_traffic(tm, tn, m, n, k, numOp, dbyte))
+
+    trange = [8, 16, 32, 64, 128, 192, 256, 320, 384, 448, 512]
+
+    l1_tk = 32
+    opt_config = [0, 0]
+    min_cost = float('inf')
+    for l1_tm in trange:
+        for l1_tn in trange:
+            l1_tm = min(l1_tm, m)
+            l1_tn = min(l1_tn, n)
+            required_capacity = (
+                l1_tm + l1_tn) * l1_tk * dbyte + l1_tm * l1_tn * dbyte
+            if required_capacity > device.l1_cache_size:
+                continue
+            l2_access = traffic(l1_tm, l1_tn)
+
+            num_threadblock = numOp
+            if type == LayerType.FC:
+                num_threadblock = math.ceil(m / l1_tm) * math.ceil(
+                    n / l1_tn) * numOp
+
+            tmp = math.ceil(num_threadblock / device.num_core) * device.num_core
+            core_utilization = num_threadblock / tmp
+            cost = l2_access * pow((1 / core_utilization), 2)
+            if cost < min_cost:
+                min_cost = cost
+                opt_config = [l1_tm, l1_tn]
+
+    l1_tm, l1_tn = opt_config
+    l2_tk = k / 64
+
+    min_access = float('inf')
+    opt_config = [0, 0]
+    for l2_tm in [l1_tm * i for i in range(1, int(m / l1_tm) + 1)] + [m]:
+        for l2_tn in [l1_tn * i for i in range(1, int(n / l1_tn) + 1)] + [n]:
+            l2_tm = min(l2_tm, m)
+            l2_tn = min(l2_tn, n)
+            required_capacity = (
+                l2_tm + l2_tn) * l2_tk * dbyte + l2_tm * l2_tn * dbyte
+            if required_capacity > device.l2_cache_size:
+                if l2_tm != l1_tm or l2_tn != l1_tn:
+                    continue
+
+            access = math.ceil(m / l2_tm) * n * k * dbyte + \
+                      math.ceil(n / l2_tn) * m * k * dbyte + m * n * dbyte
+
+            if access < min_access:
+                min_access = access
+                opt_config = [l2_tm, l2_tn]
+
+    l2_tm, l2_tn = opt_config
+    return [l1_tm, l1_tn, l1_tk, l2_tm, l2_tn, l2_tk]
+
+
+def model_shapes(name, dtype, ngpu, points):
+    # distinct FC/MATMUL shapes of a model per stage, in the order they are
+    # costed
+    model = Transformer(make_model_config(name, dtype), tensor_parallel=ngpu)
+    shapes = {'sum': {}, 'gen': {}}
+    for batch, lin, lout in points:
+        model.build_sum(batch, lin)
+        layers = model.sum_decoder + model.gen_block(batch, lin, 1)
+        for stage in range(2, lout, 1):
+            layers += model.stage_layers(batch, lin, stage)
+        for layer in layers:
+            if layer.type in [LayerType.FC, LayerType.MATMUL]:
+                shapes[layer.stage].setdefault(
+                    layer.get_infos(), (layer.type, ) + layer.get_infos())
+    return {stage: list(v.values()) for stage, v in shapes.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the vectorized tile search",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--model",
+                        type=str,
+                        nargs='+',
+                        default=list(MODEL_TABLE.keys()),
+                        help="models of make_model_config")
+    parser.add_argument("--gpu",
+                        type=str,
+                        default='A100a',
+                        help="GPU type (A100a and H100)")
+    parser.add_argument("--ngpu", type=int, default=8, help="number of GPUs")
+    args = parser.parse_args()
+
+    config = make_xpu_config(GPUType[args.gpu], num_gpu=args.ngpu)['GPU']
+    row = "{:>10} {:>6} {:>5} {:>8} {:>12.3f} {:>12.3f} {:>7.1f}x"
+    print("{:>10} {:>6} {:>5} {:>8} {:>12} {:>12} {:>8}".format(
+        'model', 'dtype', 'stage', 'shapes', 'loops (s)', 'vector (s)',
+        'speedup'))
+    total = {'sum': [0, 0], 'gen': [0, 0]}
+    for name in args.model:
+        for dtype in [DataType.W16A16, DataType.W8A8]:
+            stages = model_shapes(name, dtype, args.ngpu, POINTS)
+            device = xPU(DeviceType.GPU, config, SCALING_FACTOR)
+            for stage, shapes in stages.items():
+                start = time.perf_counter()
+                for shape in shapes:
+                    reference_tile(device, *shape)
+                loops = time.perf_counter() - start
+
+                start = time.perf_counter()
+                for shape in shapes:
+                    device._optimal_tile(*shape)
+                vector = time.perf_counter() - start
+
+                total[stage] = [total[stage][0] + loops,
+                                total[stage][1] + vector]
+                print(row.format(name, dtype.name, stage, len(shapes), loops,
+                                 vector, loops / vector))
+    for stage, (loops, vector) in total.items():
+        print(row.format('all', '', stage, '', loops, vector, loops / vector))
+
+
+if __name__ == "__main__":
+    main()
@@ -47,7 +47,10 @@ def run(system: System,
         power_constraint=False,
         pipe=0,
         parallel=False,
-        output_file=None):
+        output_file=None,
+        per_stage=False,
+        stage_stride=1,
+        stage_error=False):
     print("---Run simple mode Batch {} Lin {} Lout {} pipe {} parall {}---".
           format(batch, lin, lout, pipe, parallel))
     assert system.model_set, "Need to SetModel"
@@ -58,7 +61,10 @@ def run(system: System,
                     perfs=perfs,
                     pipe=pipe,
                     parallel_ff=parallel,
-                    power_constraint=power_constraint)
+                    power_constraint=power_constraint,
+                    per_stage=per_stage,
+                    stage_stride=stage_stride,
+                    stage_error=stage_error)
     if output_file is not None:
         write_csv(output_file, perfs)
 
@@ -106,6 +112,68 @@ def main():
     parser.add_argument("--pipeopt",
                         action='store_true',
                         help="apply pipeline optimization ")
+    parser.add_argument("--tracemode",
+                        type=str,
+                        default='pipe',
+                        choices=['pipe', 'file'],
+                        help="pass PIM traces to Ramulator through a named "
+                        "pipe, or through a file (for debugging)")
+    parser.add_argument("--tracestore",
+                        type=str,
+                        default=None,
+                        help="directory of generated PIM traces shared by "
+                        "runs with and without the power constraint")
+    parser.add_argument("--tracestoresize",
+                        type=float,
+                        default=10,
+                        help="maximum size of the trace store (GB)")
+    parser.add_argument("--surrogate",
+                        action='store_true',
+                        help="estimate the cycles of shapes missing in the "
+                        "Ramulator cache from the cached results")
+    parser.add_argument("--surrogatetol",
+                        type=float,
+                        default=0.1,
+                        help="maximum relative error bound of an estimate, "
+                        "Ramulator runs otherwise")
+    parser.add_argument("--fastmode",
+                        action='store_true',
+                        help="simulate --groupsize heads per HBM and scale "
+                        "the cycles to the number of heads")
+    parser.add_argument("--groupsize",
+                        type=int,
+                        default=64,
+                        help="heads per HBM simulated in fast mode "
+                        "(multiple of 32)")
+    parser.add_argument("--ramulatortimeout",
+                        type=float,
+                        default=None,
+                        help="seconds a Ramulator run may take before it is "
+                        "killed and retried")
+    parser.add_argument("--perstage",
+                        action='store_true',
+                        help="build and cost every generation stage "
+                        "(reference for the aggregated generation stages)")
+    parser.add_argument("--energyonly",
+                        action='store_true',
+                        help="print the energy of the PIM layers from the "
+                        "PIM command counts, without running Ramulator "
+                        "(dgx-attacc)")
+    parser.add_argument("--stagestride",
+                        type=int,
+                        default=1,
+                        help="cost every --stagestride-th generation stage "
+                        "and interpolate the others")
+    parser.add_argument("--stageerror",
+                        action='store_true',
+                        help="estimate the error of --stagestride from a "
+                        "second, jittered set of stages (costs about twice "
+                        "as many stages)")
+    parser.add_argument("--tiletable",
+                        type=str,
+                        default=None,
+                        help="file of the tiles found by the GPU/CPU cost "
+                        "model, shared by runs and processes")
 
     ## set model and service environment
     parser.add_argument(
@@ -134,6 +202,13 @@ def main():
     )
 
     args = parser.parse_args()
+    if args.stagestride < 1:
+        parser.error("--stagestride must be at least 1")
+    if args.groupsize <= 0 or args.groupsize % (2 * N_CHANNEL) != 0:
+        parser.error("--groupsize must be a positive multiple of {}".format(
+            2 * N_CHANNEL))
+    if args.energyonly and args.system != 'dgx-attacc':
+        parser.error("--energyonly needs --system dgx-attacc")
 
     global RAMULATOR
     if RAMULATOR:
@@ -164,7 +239,7 @@ def main():
     dtype = DataType.W16A16 if args.word == 2 else DataType.W8A8
     modelinfos = make_model_config(args.model, dtype)
     xpu_config = make_xpu_config(gpu_device, num_gpu=num_gpu, mem_cap=gmem_cap)
-    system = System(xpu_config['GPU'], modelinfos)
+    system = System(xpu_config['GPU'], modelinfos, tile_table=args.tiletable)
     if args.system in ['dgx-attacc']:
         if args.pim == "bg":
             pim_type = PIMType.BG
@@ -175,13 +250,30 @@ def main():
         pim_config = make_pim_config(pim_type,
                                      InterfaceType.NVLINK3,
                                      power_constraint=args.powerlimit)
-        system.set_accelerator(modelinfos, DeviceType.PIM, pim_config)
+        system.set_accelerator(modelinfos,
+                               DeviceType.PIM,
+                               pim_config,
+                               trace_mode=args.tracemode,
+                               trace_store=args.tracestore,
+                               trace_store_size=args.tracestoresize,
+                               surrogate=args.surrogate,
+                               surrogate_tolerance=args.surrogatetol,
+                               fast_mode=args.fastmode,
+                               group_size=args.groupsize,
+                               timeout=args.ramulatortimeout)
 
     elif args.system in ['dgx-cpu']:
         xpu_config = make_xpu_config(gpu_device)
         system.set_xpu(xpu_config['GPU'])
         system.set_accelerator(modelinfos, DeviceType.CPU, xpu_config['CPU'])
 
+    if args.energyonly:
+        mem, comp, comm = system.attention_energy(args.batch, args.lin,
+                                                  args.lout, args.stagestride)
+        print("PIM energy per token: {:.3f} nJ (mem {:.3f}, comp {:.3f}, "
+              "comm {:.3f})".format(mem + comp + comm, mem, comp, comm))
+        return
+
     run(system,
         args.batch,
         args.lin,
@@ -189,7 +281,22 @@ def main():
         pipe=args.pipeopt,
         parallel=args.ffopt,
         output_file=output_path,
-        power_constraint=args.powerlimit)
+        power_constraint=args.powerlimit,
+        per_stage=args.perstage,
+        stage_stride=args.stagestride,
+        stage_error=args.stageerror)
+
+    if args.stagestride > 1:
+        print("Sampled stages: {} of {}".format(system.num_sampled_stages,
+                                                args.lout - 1))
+        if system.stage_error is not None:
+            print("Estimated error time {:.3f}% energy {:.3f}%".format(
+                system.stage_error[0] * 100, system.stage_error[1] * 100))
+
+    if args.system in ['dgx-attacc'] and args.surrogate:
+        ramulator = system.devices['Acc'].ramulator
+        print("Surrogate: {} shapes estimated, error bound {:.1f}%".format(
+            ramulator.num_estimates, ramulator.estimate_error * 100))
 
 
 if __name__ == "__main__":
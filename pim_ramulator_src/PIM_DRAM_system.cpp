@@ -61,6 +61,22 @@ class PIMDRAMSystem final : public IMemorySystem, public Implementation {
       register_stat(s_num_pim_set_model_requests).name("total_num_pim_set_model_requests");
       register_stat(s_num_pim_set_head_requests).name("total_num_pim_set_head_requests");
       register_stat(s_num_other_requests).name("total_num_other_requests");
+
+      // Per-channel PIM activity (the stats of the controllers are not printed)
+      const std::vector<std::pair<int, std::string>> pim_stat_names = {
+        {Request::Type::PIM_MAC_AB, "mac_all_bank"}, {Request::Type::PIM_MAC_SB, "mac_same_bank"},
+        {Request::Type::PIM_MAC_PB, "mac_per_bank"}, {Request::Type::PIM_WR_GB, "write_to_gemv_buffer"},
+        {Request::Type::PIM_MV_SB, "move_to_softmax_buffer"}, {Request::Type::PIM_MV_GB, "move_to_gemv_buffer"},
+        {Request::Type::PIM_SFM, "softmax"}
+      };
+      for (int i = 0; i < num_channels; i++) {
+        IDRAMController* controller = m_controllers[i];
+        register_stat(controller->s_busy_cycles).name("busy_cycles_{}", i);
+        register_stat(controller->s_barrier_stall_cycles).name("barrier_stall_cycles_{}", i);
+        for (auto& [type_id, name] : pim_stat_names) {
+          register_stat(controller->s_pim_type_cycles[type_id]).name("pim_{}_cycles_{}", name, i);
+        }
+      }
     };
 
     void setup(IFrontEnd* frontend, IMemorySystem* memory_system) override { }
@@ -120,6 +120,16 @@ class HBM3PIMController final : public IDRAMController, public Implementation {
         plugin->update(request_found, req_it);
       }
 
+      // PIM stats: the cycle counts for the issued PIM request, otherwise for the oldest one
+      if (request_found && is_pim) {
+        s_pim_type_cycles[req_it->type_id]++;
+      } else if (m_pim_buffer.size()) {
+        s_pim_type_cycles[m_pim_buffer.begin()->type_id]++;
+        if (!request_found && is_barrier_stall()) {
+          s_barrier_stall_cycles++;
+        }
+      }
+
       // 4. Finally, issue the commands to serve the request
       if (request_found) {
         // If we find a real request to serve
@@ -171,6 +181,10 @@ class HBM3PIMController final : public IDRAMController, public Implementation {
           }
         }
       }
+
+      if (is_pending()) {
+        s_busy_cycles++;
+      }
     };
 
 
@@ -209,6 +223,28 @@ class HBM3PIMController final : public IDRAMController, public Implementation {
     };
 
 
+    /**
+     * @brief    Checks if a PIM request behind a barrier could be issued
+     * @details
+     * The PIM scheduler does not reorder requests across a barrier, so a ready
+     * request behind it waits for the requests in front of the barrier.
+     */
+    bool is_barrier_stall() {
+      bool barrier = false;
+      for (auto& req : m_pim_buffer) {
+        if (req.type_id == Request::Type::PIM_BARRIER) {
+          barrier = true;
+        } else if (barrier) {
+          int command = m_dram->get_preq_command(req.final_command, req.addr_vec);
+          if (m_dram->check_ready(command, req.addr_vec)) {
+            return true;
+          }
+        }
+      }
+      return false;
+    };
+
+
     /**
      * @brief    Checks if we need to switch to write mode
      * 
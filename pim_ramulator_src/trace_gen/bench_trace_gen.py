@@ -0,0 +1,58 @@
+import argparse
+import filecmp
+import os
+import tempfile
+import time
+
+import gen_trace_attacc_bank
+import gen_trace_attacc_bg
+import gen_trace_attacc_buffer
+import gen_trace_attacc_vec
+
+## Compares the reference generators with the vectorized one:
+## checks that the traces are byte-identical and reports the speedup.
+
+REFERENCE = {'bank': gen_trace_attacc_bank,
+             'bg': gen_trace_attacc_bg,
+             'buffer': gen_trace_attacc_buffer}
+
+# (dhead, nhead per HBM, L, dbyte)
+SHAPES = [(128, 32, 2048, 2),
+          (128, 96, 4096, 2),
+          (160, 17, 777, 1),
+          (128, 130, 2049, 2)]
+
+
+def timed(func, *args):
+  start = time.perf_counter()
+  func(*args)
+  return time.perf_counter() - start
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark of the vectorized trace generator",
+                               formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("-p", "--pim", type=str, nargs='+', default=gen_trace_attacc_vec.PIM_TYPES,
+                      choices=gen_trace_attacc_vec.PIM_TYPES, help="PIM types")
+  parser.add_argument("-r", "--repeat", type=int, default=1,
+                      help="runs per generator, the best time is reported")
+  args = parser.parse_args()
+
+  print("{:>6} {:>5} {:>5} {:>5} {:>5} {:>10} {:>10} {:>8} {:>9}".format(
+        'pim', 'dhead', 'nhead', 'L', 'dbyte', 'ref (s)', 'vec (s)', 'speedup', 'identical'))
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    ref_trace = os.path.join(tmp_dir, 'ref.trace')
+    vec_trace = os.path.join(tmp_dir, 'vec.trace')
+    for pim in args.pim:
+      for dhead, nhead, L, dbyte in SHAPES:
+        ref_time = min(timed(REFERENCE[pim].run_attention, dhead, nhead, L, ref_trace, dbyte)
+                       for _ in range(args.repeat))
+        vec_time = min(timed(gen_trace_attacc_vec.run_attention, pim, dhead, nhead, L, vec_trace, dbyte)
+                       for _ in range(args.repeat))
+        identical = filecmp.cmp(ref_trace, vec_trace, shallow=False)
+        print("{:>6} {:>5} {:>5} {:>5} {:>5} {:>10.3f} {:>10.3f} {:>7.1f}x {:>9}".format(
+              pim, dhead, nhead, L, dbyte, ref_time, vec_time, ref_time / vec_time, str(identical)))
+
+
+if __name__ == "__main__":
+  main()
@@ -1,4 +1,5 @@
 import argparse
+import itertools
 import math
 import copy
 import numpy as np
@@ -22,6 +23,9 @@ n_col = pow(2, 5)
 prefetch_size = 32 # byte
 n_mac = 16
 
+CHUNK_CMDS = 4096 # commands per write
+WRITE_BUFFER = 1 << 20 # byte
+
 
 # Granularity size
 HBM_GS = {}
@@ -47,39 +51,11 @@ HBM_GS['attacc']  = max_n_hbm * HBM_GS['hbm']
 ##  MVGB: 4tCK
 ##  SFM: 16tCK (for L = 256)
 
-cmd_score_wrgb   = []
-cmd_score_mac    = []
-cmd_score_mvsb   = []
-cmd_sfm          = []
-cmd_context_mvgb  = []
-cmd_context_mac  = []
-cmd_context_mvsb = []
-
-valid_channels = []
-
-def cmd_list_reset():
-  cmd_score_wrgb   = []
-  cmd_score_mac    = []
-  cmd_score_mvsb   = []
-  cmd_sfm          = []
-  cmd_context_mvgb = []
-  cmd_context_mac  = []
-  cmd_context_mvsb = []
-
-  valid_channel = []
-
-def Attention(L, key_addr, val_addr, itr, valid_channel = n_channel):
-  cmd_score_wrgb.append([])
-  cmd_score_mac.append([])
-  cmd_score_mvsb.append([])
-  cmd_sfm.append([])
-  cmd_context_mvgb.append([])
-  cmd_context_mac.append([])
-  cmd_context_mvsb.append([])
-
-  valid_channels.append(valid_channel);
-
-  def score_cpvec(addr_offset, L):
+def Attention(L, key_addr, val_addr, dhead, n_mac, valid_channel = n_channel):
+  ## Command generators of a head. Commands are produced on demand, so the
+  ## memory footprint does not depend on L.
+
+  def score_cpvec(addr_offset=key_addr):
     ## (pCH) C R (MAC)
     ## write input vector to gemv buffer
     # number of partition = (R parallel units)
@@ -89,45 +65,43 @@ def Attention(L, key_addr, val_addr, itr, valid_channel = n_channel):
         # GEMV buffer address, col granularity = 1
         addr = addr_offset + lch * HBM_GS['ch'] + col_idx
         hex_addr = hex(addr)[2:]
-        cmd_score_wrgb[itr].append("PIM_WR_GB 0x{0:0>8}".format(hex_addr))
+        yield "PIM_WR_GB 0x{0:0>8}".format(hex_addr)
 
-  def score_mac(addr_offset, L):
+  def score_mac(n_idx, addr_offset=key_addr):
     ## (pCH) C R (MAC)
     # MAC and move output vector to softmax buffer
     ## Vector (1 x k) x Matrix (k x n) multiplication
     ## GEMV unit = adder tree mode
-    for n_idx in range(math.ceil(L / n_pch)):
-      cmd_score_mac[itr].append([])
-      for k_idx in range(math.ceil(dhead / n_mac)):
-        idx = k_idx + n_idx * math.ceil(dhead / n_mac) 
-
-        bg_idx = idx % (n_bg * n_rank) 
-        num_bg_indices = int(idx / (n_bg * n_rank))
-
-        bank_idx = num_bg_indices % (n_bank)
-        num_bank_indices = int(num_bg_indices / n_bank)
-
-        col_idx = num_bank_indices % (int(HBM_GS['row'] / HBM_GS['col'])) 
-        row_idx = int(num_bank_indices / (int(HBM_GS['row'] / HBM_GS['col'])))
-
-        # All bank command (legacy channel)
-        for lch in range(math.ceil(valid_channel)):
-          addr = addr_offset + lch * HBM_GS['ch'] + bg_idx * HBM_GS['bg'] + \
-                 bank_idx * HBM_GS['ba'] + row_idx * HBM_GS['row'] + col_idx * HBM_GS['col']
-          hex_addr = hex(addr)[2:]
-          cmd_score_mac[itr][-1].append("PIM_MAC_PB 0x{0:0>8}".format(hex_addr))
-         ## parallelization
-
-      ## MVSB command (Move to Softmax buffer) 
-      ## A output element is generated for every n_idx
-      if n_idx % 16 == 15 or n_idx == math.ceil(L / n_pch) - 1:
-        cmd_score_mvsb[itr].append([])
-        for lch in range(math.ceil(valid_channel)):
-          addr = addr_offset + lch * HBM_GS['ch']
-          hex_addr = hex(addr)[2:]
-          cmd_score_mvsb[itr][-1].append("PIM_MV_SB 0x{0:0>8}".format(hex_addr))
-
-  def context_cpvec(addr_offset, L):
+    ## n_idx in range(math.ceil(L / n_pch))
+    for k_idx in range(math.ceil(dhead / n_mac)):
+      idx = k_idx + n_idx * math.ceil(dhead / n_mac) 
+
+      bg_idx = idx % (n_bg * n_rank) 
+      num_bg_indices = int(idx / (n_bg * n_rank))
+
+      bank_idx = num_bg_indices % (n_bank)
+      num_bank_indices = int(num_bg_indices / n_bank)
+
+      col_idx = num_bank_indices % (int(HBM_GS['row'] / HBM_GS['col'])) 
+      row_idx = int(num_bank_indices / (int(HBM_GS['row'] / HBM_GS['col'])))
+
+      # All bank command (legacy channel)
+      for lch in range(math.ceil(valid_channel)):
+        addr = addr_offset + lch * HBM_GS['ch'] + bg_idx * HBM_GS['bg'] + \
+               bank_idx * HBM_GS['ba'] + row_idx * HBM_GS['row'] + col_idx * HBM_GS['col']
+        hex_addr = hex(addr)[2:]
+        yield "PIM_MAC_PB 0x{0:0>8}".format(hex_addr)
+       ## parallelization
+
+  def score_mvsb(addr_offset=key_addr):
+    ## MVSB command (Move to Softmax buffer) 
+    ## issued every 16 n_idx and after the last n_idx
+    for lch in range(math.ceil(valid_channel)):
+      addr = addr_offset + lch * HBM_GS['ch']
+      hex_addr = hex(addr)[2:]
+      yield "PIM_MV_SB 0x{0:0>8}".format(hex_addr)
+
+  def context_cpvec(addr_offset=val_addr):
     ## (pCH) R C (MAC)
     ## write input vector to gemv buffer
     # number of columns of partition = L / (R parallel units)
@@ -136,75 +110,66 @@ def Attention(L, key_addr, val_addr, itr, valid_channel = n_channel):
         # GEMV buffer address, col granularity = 1
         addr = addr_offset + lch * HBM_GS['ch'] + col_idx
         hex_addr = hex(addr)[2:]
-        cmd_context_mvgb[itr].append("PIM_MV_GB 0x{0:0>8}".format(hex_addr))
+        yield "PIM_MV_GB 0x{0:0>8}".format(hex_addr)
 
-  def context_mac(addr_offset, L):
+  def context_mac(n_idx, addr_offset=val_addr):
     ## (pCH) R C (MAC)
     # MAC and move output vector to softmax buffer
     ## Vector (1xk) x Matrix (k x n ) multiplication
     ## GEMV unit = mac mode
-    for n_idx in range(math.ceil(dhead / (n_mac))):
-      cmd_context_mac[itr].append([])
-      for k_idx in range(math.ceil(L / (n_pch))):
-        idx = k_idx + n_idx * math.ceil(L / (n_pch))
-        bg_idx = idx % (n_bg * n_rank) 
-        num_bg_indices = int(idx / (n_bg * n_rank))
-
-        bank_idx = num_bg_indices % (n_bank)
-        num_bank_indices = int(num_bg_indices / n_bank)
-
-        col_idx = num_bank_indices % (int(HBM_GS['row'] / HBM_GS['col'])) 
-        row_idx = int(num_bank_indices / (int(HBM_GS['row'] / HBM_GS['col'])))
-
-        for lch in range(math.ceil(valid_channel)):
-          addr = addr_offset + lch * HBM_GS['ch'] + bg_idx * HBM_GS['bg'] + \
-                 bank_idx * HBM_GS['ba'] + row_idx * HBM_GS['row'] + col_idx * HBM_GS['col']
-          hex_addr = hex(addr)[2:]
-          cmd_context_mac[itr][-1].append("PIM_MAC_PB 0x{0:0>8}".format(hex_addr))
-
-      ## parallelization. Generate 16 elements per n_idx
-      cmd_context_mvsb[itr].append([])
+    ## n_idx in range(math.ceil(dhead / (n_mac)))
+    for k_idx in range(math.ceil(L / (n_pch))):
+      idx = k_idx + n_idx * math.ceil(L / (n_pch))
+      bg_idx = idx % (n_bg * n_rank) 
+      num_bg_indices = int(idx / (n_bg * n_rank))
+
+      bank_idx = num_bg_indices % (n_bank)
+      num_bank_indices = int(num_bg_indices / n_bank)
+
+      col_idx = num_bank_indices % (int(HBM_GS['row'] / HBM_GS['col'])) 
+      row_idx = int(num_bank_indices / (int(HBM_GS['row'] / HBM_GS['col'])))
+
       for lch in range(math.ceil(valid_channel)):
-        addr = addr_offset + lch * HBM_GS['ch']
+        addr = addr_offset + lch * HBM_GS['ch'] + bg_idx * HBM_GS['bg'] + \
+               bank_idx * HBM_GS['ba'] + row_idx * HBM_GS['row'] + col_idx * HBM_GS['col']
         hex_addr = hex(addr)[2:]
-        cmd_context_mvsb[itr][-1].append("PIM_MV_SB 0x{0:0>8}".format(hex_addr))
+        yield "PIM_MAC_PB 0x{0:0>8}".format(hex_addr)
 
-  def softmax(L):
+  def context_mvsb(addr_offset=val_addr):
+    ## parallelization. Generate 16 elements per n_idx
     for lch in range(math.ceil(valid_channel)):
-      addr = lch * HBM_GS['ch'] 
+      addr = addr_offset + lch * HBM_GS['ch']
       hex_addr = hex(addr)[2:]
-      cmd_sfm[itr].append("PIM_SFM 0x{0:0>8}".format(hex_addr))
-
-  score_cpvec(key_addr, L)
-
-  score_mac(key_addr, L)
-
-  softmax(L)
+      yield "PIM_MV_SB 0x{0:0>8}".format(hex_addr)
 
-  context_cpvec(val_addr, L)
+  def softmax():
+    for lch in range(math.ceil(valid_channel)):
+      addr = lch * HBM_GS['ch'] 
+      hex_addr = hex(addr)[2:]
+      yield "PIM_SFM 0x{0:0>8}".format(hex_addr)
 
-  context_mac(val_addr, L)
+  return score_cpvec, score_mac, score_mvsb, softmax, \
+         context_cpvec, context_mac, context_mvsb
 
 
-def run_attention(dhead, n_head_per_hbm, L, trace_file_name):
+# n_head and n_req = n_req per a HBM, yields the overlapped schedule command by command
+def attention_cmds(dhead, n_head_per_hbm, L, dbyte=2, max_L=4096):
+  n_mac = int(HBM_GS['col'] / dbyte)
   partition_size = math.ceil(max_L * dhead / (n_pch * n_rank * n_bg * n_bank))
   head_offset = partition_size
   v_offset = pow(2, 23) 
-  
 
-  cmd_list_reset()
   ##-- Generate Commands --##
+  ## the commands of a head are generated when the head is scheduled
   num_itr = math.ceil(n_head_per_hbm / (n_channel))
-  for itr in range(num_itr):
+  def head(itr):
     remainder = 0
     if (n_head_per_hbm / ((itr+1) * n_channel) < 1):
       remainder = n_head_per_hbm % n_channel
     key_addr = itr * partition_size 
     val_addr = key_addr + v_offset
-    if remainder == 0:
-      Attention(L, key_addr, val_addr, itr)
-    else:
-      Attention(L, key_addr, val_addr, itr, remainder)
+    valid_channel = n_channel if remainder == 0 else remainder
+    return Attention(L, key_addr, val_addr, dhead, n_mac, valid_channel), valid_channel
 
 
   ##-- Ovelapping Commands --##
@@ -214,116 +179,116 @@ def run_attention(dhead, n_head_per_hbm, L, trace_file_name):
     hex_addr = hex(addr)[2:]
     barrier.append("PIM_BARRIER 0x{0:0>8}".format(hex_addr))
 
-  total_cmd = []
+  n_score = math.ceil(L / n_pch)
   for i in range(0, num_itr -1, 2):
+    (score_wrgb0, score_mac0, score_mvsb0, sfm0, context_mvgb0, context_mac0, context_mvsb0), \
+      valid_channel0 = head(i)
+    (score_wrgb1, score_mac1, score_mvsb1, sfm1, context_mvgb1, context_mac1, context_mvsb1), \
+      valid_channel1 = head(i+1)
 
     # Head0: Score
       ## WRGB
-    total_cmd += cmd_score_wrgb[i]
+    yield from score_wrgb0()
       ## dummy MAC
     if i == 0:
-      for j in range(valid_channels[i]):
-        total_cmd.append(cmd_score_mac[i][0][j])
+      yield from itertools.islice(score_mac0(0), valid_channel0)
       ## BARRIER
-    total_cmd += barrier
+    yield from barrier
 
+    ## the WRGB (Head1) and MVGB commands are consumed in order, stride by stride
+    wrgb1 = score_wrgb1()
     length = math.ceil(L/n_pch/16)
     for j in range(0, length+1):
       ## MAC (Head0)
       if not j == length:
         stride = 16;
         for k in range(stride):
-          if (j*stride+k) >= len(cmd_score_mac[i]):
+          if (j*stride+k) >= n_score:
             break;
-          total_cmd += cmd_score_mac[i][j*stride+k]
+          yield from score_mac0(j*stride+k)
       ## MVSB (Head0)
       if not j == 0:
-        total_cmd += cmd_score_mvsb[i][j-1]
+        yield from score_mvsb0()
       ## WRGB (Head1)
       if not j == length:
-        stride = int(math.ceil(dhead/n_mac)*math.ceil(valid_channels[i+1])/length);
-        for k in range(stride):
-          if (j*stride+k) >= len(cmd_score_wrgb[i+1]):
-            break;
-          total_cmd.append(cmd_score_wrgb[i+1][j*stride + k])
+        stride = int(math.ceil(dhead/n_mac)*math.ceil(valid_channel1)/length);
+        yield from itertools.islice(wrgb1, stride)
       ## BARRIER
       if not j == length:
-        total_cmd += barrier
+        yield from barrier
 
     # Head0: SoftMax, Head1: Score
+    mvgb0 = context_mvgb0()
     length = math.ceil(L/n_pch/16)
     for j in range(0, length+1):
       ## MAC (Head1)
       if not j == length:
         stride = 16;
         for k in range(stride):
-          if (j*stride+k) >= len(cmd_score_mac[i+1]):
+          if (j*stride+k) >= n_score:
             break;
-          total_cmd += cmd_score_mac[i+1][j*stride+k]
+          yield from score_mac1(j*stride+k)
       ## MVSB (Head1)
       if not j == 0:
-        total_cmd += cmd_score_mvsb[i+1][j-1]
+        yield from score_mvsb1()
       ## SFM (Head0)
       if j == 0:
-        total_cmd += cmd_sfm[i]
+        yield from sfm0()
       ## MVGB (Head0)
       if not j == length:
         if j >= math.floor(length/2):
-          stride = int(math.ceil(L/(n_pch*n_mac))*math.ceil(valid_channels[i])/math.ceil(length/2));
-          for k in range(stride):
-            if ((j-math.floor(length/2))*stride + k) >= len(cmd_context_mvgb[i]):
-              break;
-            total_cmd.append(cmd_context_mvgb[i][(j-math.floor(length/2))*stride + k])
+          stride = int(math.ceil(L/(n_pch*n_mac))*math.ceil(valid_channel0)/math.ceil(length/2));
+          yield from itertools.islice(mvgb0, stride)
       ## BARRIER
       if not j == length:
-        total_cmd += barrier
+        yield from barrier
 
     # Head0: Context, Head1: Softmax
+    mvgb1 = context_mvgb1()
     length = math.ceil(dhead/n_mac)
     for j in range(0, length+1):
       ## MAC (Head0)
       if not j == length:
-        total_cmd += cmd_context_mac[i][j]
+        yield from context_mac0(j)
       ## MVSB (Head0)
       if not j == 0:
-        total_cmd += cmd_context_mvsb[i][j-1]
+        yield from context_mvsb0()
       ## SFM (Head1)
       if j == 0:
-        total_cmd += cmd_sfm[i+1]
+        yield from sfm1()
       ## MVGB (Head1)
       if not j == length:
         if j >= math.floor(length/2):
-          stride = int(math.ceil(L/(n_pch*n_mac))*math.ceil(valid_channels[i+1])/math.ceil(length/2));
-          for k in range(stride):
-            if ((j-math.floor(length/2))*stride + k) >= len(cmd_context_mvgb[i+1]):
-              break;
-            total_cmd.append(cmd_context_mvgb[i+1][(j-math.floor(length/2))*stride + k])
+          stride = int(math.ceil(L/(n_pch*n_mac))*math.ceil(valid_channel1)/math.ceil(length/2));
+          yield from itertools.islice(mvgb1, stride)
       ## BARRIER
       if not j == length:
-        total_cmd += barrier
+        yield from barrier
 
     # Head1: Context
     length = math.ceil(dhead/n_mac)
     for j in range(0, length+1):
       ## MAC (Head0)
       if not j == length:
-        total_cmd += cmd_context_mac[i][j]
+        yield from context_mac0(j)
       ## MVSB (Head0)
       if not j == 0:
-        total_cmd += cmd_context_mvsb[i][j-1]
+        yield from context_mvsb0()
       ## BARRIER
       if not j == length:
-        total_cmd += barrier
+        yield from barrier
 
 
   if num_itr % 2 != 0:
     i = num_itr - 1
+    (score_wrgb, score_mac, score_mvsb, sfm, context_mvgb, context_mac, context_mvsb), \
+      valid_channel = head(i)
 
     # Score
       ## WRGB
-    total_cmd += cmd_score_wrgb[i]
+    yield from score_wrgb()
       ## BARRIER
-    total_cmd += barrier
+    yield from barrier
 
     length = math.ceil(L/n_pch/16)
     for j in range(0, length+1):
@@ -331,48 +296,56 @@ def run_attention(dhead, n_head_per_hbm, L, trace_file_name):
       if not j == length:
         stride = 16;
         for k in range(stride):
-          if (j*stride+k) >= len(cmd_score_mac[i]):
+          if (j*stride+k) >= n_score:
             break;
-          total_cmd += cmd_score_mac[i][j*stride+k]
+          yield from score_mac(j*stride+k)
       ## MVSB
       if not j == 0:
-        total_cmd += cmd_score_mvsb[i][j-1]
+        yield from score_mvsb()
       ## BARRIER
       if not j == length:
-        total_cmd += barrier
+        yield from barrier
 
     # SoftMax
     ## SFM (Head0)
-    total_cmd += cmd_sfm[i]
+    yield from sfm()
     ## MVGB (Head0)
-    total_cmd += cmd_context_mvgb[i]
+    yield from context_mvgb()
     ## BARRIER
-    total_cmd += barrier
+    yield from barrier
 
     # Context
     length = math.ceil(dhead/n_mac)
     for j in range(0, length+1):
       ## MAC
       if not j == length:
-        total_cmd += cmd_context_mac[i][j]
+        yield from context_mac(j)
       ## MVSB
       if not j == 0:
-        total_cmd += cmd_context_mvsb[i][j-1]
+        yield from context_mvsb()
       ## BARRIER
       if not j == length:
-        total_cmd += barrier
+        yield from barrier
 
 
-  trace_file = open(trace_file_name, 'w')
-  for cmd in total_cmd:
-    trace_file.write(cmd + "\n")
+# n_head and n_req = n_req per a HBM, returns the number of commands
+def run_attention(dhead, n_head_per_hbm, L, trace_file_name, dbyte=2, max_L=4096):
+  ## Commands are written in chunks of CHUNK_CMDS through a buffered writer,
+  ## the memory footprint does not depend on L and the number of heads
+  cmds = attention_cmds(dhead, n_head_per_hbm, L, dbyte, max_L)
+  num_cmds = 0
+  with open(trace_file_name, 'w', buffering=WRITE_BUFFER) as trace_file:
+    while True:
+      chunk = list(itertools.islice(cmds, CHUNK_CMDS))
+      if not chunk:
+        break
+      trace_file.write("\n".join(chunk) + "\n")
+      num_cmds += len(chunk)
 
-  trace_file.close()
-
-def main():
-  global dhead, max_L, data_size, n_mac
+  return num_cmds
 
 
+def main():
   parser = argparse.ArgumentParser(description="Output path and operation infos",
                                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
  
@@ -391,14 +364,6 @@ def main():
 
   args = parser.parse_args()
 
-  dhead = args.dhead
-  max_L = args.maxlen
-  L = args.seqlen
-  n_head_per_hbm = args.nhead 
-
-  data_size = args.dbyte
-  n_mac = int(HBM_GS['col'] / data_size)
-
   print("------   Make a trace of buffer-level AttAcc   ------")
 
   args_dict = vars(args)
@@ -406,7 +371,8 @@ def main():
   for key, value in args_dict.items():
       print(f"     {key}: {value}")
   print("---------------------------------------------------")
-  run_attention(dhead, n_head_per_hbm, L, args.output)
+  run_attention(args.dhead, args.nhead, args.seqlen, args.output, args.dbyte,
+                args.maxlen)
 
 
 
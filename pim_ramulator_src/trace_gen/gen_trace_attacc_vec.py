@@ -0,0 +1,478 @@
+import argparse
+import math
+import numpy as np
+
+## Vectorized trace generator for bank-, BG- and buffer-level AttAcc.
+## Produces the same trace, byte for byte, as gen_trace_attacc_{bank,bg,buffer}.py
+## but builds each command group with NumPy and formats whole blocks at once.
+
+n_channel = 16
+n_pch = 2
+n_rank = 2
+n_bank = 4
+n_bg = 4
+n_row = pow(2, 14)
+n_col = pow(2, 5)
+prefetch_size = 32 # byte
+
+
+# Granularity size
+HBM_GS = {}
+HBM_GS['col']     = prefetch_size
+HBM_GS['row']     = n_col * HBM_GS['col']
+HBM_GS['ba']      = n_row * HBM_GS['row']
+HBM_GS['bg']      = n_bank * HBM_GS['ba']
+HBM_GS['rank']    = n_bg * HBM_GS['bg']
+HBM_GS['pch']     = n_rank * HBM_GS['rank']
+HBM_GS['ch']      = n_pch * HBM_GS['pch']
+
+PIM_TYPES = ['bank', 'bg', 'buffer']
+
+## ----------------------------  Commands -------------------------------##
+WRGB, MAC_AB, MAC_SB, MAC_PB, MVSB, MVGB, SFM, BARRIER = range(8)
+CMD_NAMES = ['PIM_WR_GB', 'PIM_MAC_AB', 'PIM_MAC_SB', 'PIM_MAC_PB',
+             'PIM_MV_SB', 'PIM_MV_GB', 'PIM_SFM', 'PIM_BARRIER']
+MAC_CMD = {'bank': MAC_AB, 'bg': MAC_SB, 'buffer': MAC_PB}
+
+## Address offset selectors: the command address is base + offsets[sel], where
+## offsets = [0, key(head0), val(head0), key(head1), val(head1)]
+NONE, KEY0, VAL0, KEY1, VAL1 = range(5)
+
+## number of commands formatted at once
+CHUNK_CMDS = 1 << 17
+
+
+def _prefix_table():
+  width = max(len(name) for name in CMD_NAMES) + len(' 0x')
+  table = np.zeros((len(CMD_NAMES), width), dtype=np.uint8)
+  mask = np.zeros((len(CMD_NAMES), width), dtype=bool)
+  for code, name in enumerate(CMD_NAMES):
+    prefix = np.frombuffer((name + ' 0x').encode(), dtype=np.uint8)
+    table[code, width - len(prefix):] = prefix
+    mask[code, width - len(prefix):] = True
+  return table, mask
+
+PREFIX, PREFIX_MASK = _prefix_table()
+
+
+def format_commands(codes, addrs):
+  ## "NAME 0x{hex:0>8}\n" for every (code, addr) pair
+  n = len(addrs)
+  ndigits = np.full(n, 8, dtype=np.int64)
+  width = 8
+  while (addrs >> (4 * width)).any():
+    ndigits += (addrs >> (4 * width)) > 0
+    width += 1
+
+  ## nibbles of the big-endian address bytes, then ASCII hex digits
+  addr_bytes = addrs.astype('>u8').view(np.uint8).reshape(n, 8)
+  nibbles = np.empty((n, 16), dtype=np.uint8)
+  nibbles[:, 0::2] = addr_bytes >> 4
+  nibbles[:, 1::2] = addr_bytes & 0xF
+  digits = nibbles[:, 16 - width:]
+
+  n_prefix = PREFIX.shape[1]
+  lines = np.empty((n, n_prefix + width + 1), dtype=np.uint8)
+  lines[:, :n_prefix] = PREFIX[codes]
+  lines[:, n_prefix:-1] = digits + ord('0') + (digits > 9) * np.uint8(ord('a') - ord('0') - 10)
+  lines[:, -1] = ord('\n')
+
+  keep = np.ones(lines.shape, dtype=bool)
+  keep[:, :n_prefix] = PREFIX_MASK[codes]
+  keep[:, n_prefix:-1] = np.arange(width)[None, :] >= (width - ndigits)[:, None]
+  return lines[keep].tobytes()
+
+
+def _nest(*axes):
+  ## flattened sum of nested loops, the first axis is the outermost loop
+  out = np.zeros(1, dtype=np.int64)
+  for values in axes:
+    out = (out[:, None] + np.asarray(values, dtype=np.int64)[None, :]).ravel()
+  return out
+
+
+def _steps(n, step):
+  return np.arange(n, dtype=np.int64) * step
+
+
+class Rows:
+  ## 2D MAC group, one row of k * n_lch commands per n_idx, computed on access
+  ## so that its size (which grows with L * dhead) is never held in memory
+  def __init__(self, addr, n, k, lch):
+    self.addr = addr
+    self.n = n
+    self.k = k
+    self.lch = lch
+
+  def __len__(self):
+    return self.n
+
+  def __getitem__(self, idx):
+    if isinstance(idx, slice):
+      start, stop, _ = idx.indices(self.n)
+      stop = max(start, stop)
+    else:
+      start, stop = idx, idx + 1
+    rows = _nest(self.addr(np.arange(start * self.k, stop * self.k, dtype=np.int64)), self.lch)
+    rows = rows.reshape(stop - start, self.k * len(self.lch))
+    return rows if isinstance(idx, slice) else rows[0]
+
+
+def Attention(pim_type, L, dhead, n_mac, valid_channel = n_channel):
+  ## Commands of a head at address offset 0.
+  ## MAC and MVSB groups are 2D (one row per n_idx / per MVSB group).
+  lch = _steps(math.ceil(valid_channel), HBM_GS['ch'])
+  cmds = {}
+
+  if pim_type == 'bank':
+    n_score = math.ceil(L / n_pch / n_rank / n_bg)
+    k_score = math.ceil(dhead / n_bank / n_mac)
+    n_context = math.ceil(dhead / (n_bank * n_mac))
+    k_context = math.ceil(L / (n_pch * n_rank * n_bg))
+
+    cmds['score_wrgb'] = _nest(_steps(n_bank, HBM_GS['ba']), _steps(k_score, 1), lch)
+    def col_addr(idx):
+      return idx * HBM_GS['col']
+
+    cmds['score_mac'] = Rows(col_addr, n_score, k_score, lch)
+    score_mvsb = _nest(_steps(n_bg, HBM_GS['bg']), _steps(n_rank, HBM_GS['rank']), lch)
+    cmds['context_mvgb'] = _nest(_steps(n_rank, HBM_GS['rank']), _steps(n_bg, HBM_GS['bg']),
+                                 _steps(math.ceil(L / (n_pch * n_rank * n_bg * n_mac)), 1), lch)
+    cmds['context_mac'] = Rows(col_addr, n_context, k_context, lch)
+    context_mvsb = _nest(_steps(n_bank, HBM_GS['ba']), _steps(n_rank, HBM_GS['rank']), lch)
+
+  elif pim_type == 'bg':
+    n_score = math.ceil(L / n_pch / n_rank / n_bg)
+    k_score = math.ceil(dhead / n_mac)
+    n_context = math.ceil(dhead / (n_mac))
+    k_context = math.ceil(L / (n_pch * n_rank * n_bg))
+    n_cols = int(HBM_GS['row'] / HBM_GS['col'])
+
+    def bank_addr(idx):
+      num_cols = idx // n_cols
+      return (num_cols % n_bank) * HBM_GS['ba'] + (num_cols // n_bank) * HBM_GS['row'] + \
+             (idx % n_cols) * HBM_GS['col']
+
+    cmds['score_wrgb'] = _nest(_steps(k_score, 1), lch)
+    cmds['score_mac'] = Rows(bank_addr, n_score, k_score, lch)
+    score_mvsb = _nest(_steps(n_bg, HBM_GS['bg']), _steps(n_rank, HBM_GS['rank']), lch)
+    cmds['context_mvgb'] = _nest(_steps(n_rank, HBM_GS['rank']), _steps(n_bg, HBM_GS['bg']),
+                                 _steps(math.ceil(L / (n_pch * n_rank * n_bg * n_mac)), 1), lch)
+    cmds['context_mac'] = Rows(bank_addr, n_context, k_context, lch)
+    context_mvsb = _nest(_steps(n_rank, HBM_GS['rank']), lch)
+
+  elif pim_type == 'buffer':
+    n_score = math.ceil(L / n_pch)
+    k_score = math.ceil(dhead / n_mac)
+    n_context = math.ceil(dhead / (n_mac))
+    k_context = math.ceil(L / (n_pch))
+    n_cols = int(HBM_GS['row'] / HBM_GS['col'])
+
+    def bank_addr(idx):
+      num_bg_indices = idx // (n_bg * n_rank)
+      num_bank_indices = num_bg_indices // n_bank
+      return (idx % (n_bg * n_rank)) * HBM_GS['bg'] + (num_bg_indices % n_bank) * HBM_GS['ba'] + \
+             (num_bank_indices // n_cols) * HBM_GS['row'] + (num_bank_indices % n_cols) * HBM_GS['col']
+
+    cmds['score_wrgb'] = _nest(_steps(k_score, 1), lch)
+    cmds['score_mac'] = Rows(bank_addr, n_score, k_score, lch)
+    score_mvsb = lch
+    cmds['context_mvgb'] = _nest(_steps(math.ceil(L / (n_pch * n_mac)), 1), lch)
+    cmds['context_mac'] = Rows(bank_addr, n_context, k_context, lch)
+    context_mvsb = lch
+
+  else:
+    raise ValueError("unknown PIM type {}".format(pim_type))
+
+  ## One MVSB group every 16 n_idx and one after the last n_idx
+  cmds['score_mvsb'] = np.tile(score_mvsb, (math.ceil(n_score / 16), 1))
+  cmds['context_mvsb'] = np.tile(context_mvsb, (n_context, 1))
+  cmds['sfm'] = lch
+  return cmds
+
+
+def _lengths(pim_type, L, dhead, n_mac):
+  ## number of score and context steps
+  if pim_type == 'buffer':
+    return math.ceil(L/n_pch/16), math.ceil(dhead/n_mac)
+  if pim_type == 'bank':
+    return math.ceil(L/n_pch/n_rank/n_bg/16), math.ceil(dhead/n_bank/n_mac)
+  return math.ceil(L/n_pch/n_rank/n_bg/16), math.ceil(dhead/n_mac)
+
+
+def _wrgb_stride(pim_type, dhead, n_mac, valid_channel, length):
+  if pim_type == 'bank':
+    return int(n_bank*math.ceil(dhead /n_bank /n_mac)*math.ceil(valid_channel)/length)
+  return int(math.ceil(dhead/n_mac)*math.ceil(valid_channel)/length)
+
+
+def _mvgb_stride(pim_type, L, n_mac, valid_channel, length):
+  if pim_type == 'buffer':
+    return int(math.ceil(L/(n_pch*n_mac))*math.ceil(valid_channel)/math.ceil(length/2))
+  return int(n_rank*n_bg*math.ceil(L/(n_pch*n_rank*n_bg*n_mac))*math.ceil(valid_channel)/math.ceil(length/2))
+
+
+class Schedule:
+  ## Ordered command blocks of a head pair (or of the last odd head), passed
+  ## to sink as (codes, bases, sels) in pieces of about CHUNK_CMDS commands
+  def __init__(self, mac_cmd, sink):
+    self.mac_cmd = mac_cmd
+    self.sink = sink
+    self.codes = []
+    self.bases = []
+    self.sels = []
+    self.size = 0
+
+  def add(self, code, addrs, sel):
+    addrs = np.asarray(addrs, dtype=np.int64).ravel()
+    if len(addrs) == 0:
+      return
+    self.codes.append(np.full(len(addrs), code, dtype=np.uint8))
+    self.bases.append(addrs)
+    self.sels.append(np.full(len(addrs), sel, dtype=np.uint8))
+    self.size += len(addrs)
+    if self.size >= CHUNK_CMDS:
+      self.flush()
+
+  def flush(self):
+    if self.size > 0:
+      self.sink((np.concatenate(self.codes), np.concatenate(self.bases), np.concatenate(self.sels)))
+    self.codes = []
+    self.bases = []
+    self.sels = []
+    self.size = 0
+
+
+def pair_schedule(pim_type, L, dhead, n_mac, head0, head1, vc0, vc1, first, sink):
+  s = Schedule(MAC_CMD[pim_type], sink)
+  mac = s.mac_cmd
+  barrier = _steps(n_channel, HBM_GS['ch'])
+  score_length, context_length = _lengths(pim_type, L, dhead, n_mac)
+
+  # Head0: Score
+  s.add(WRGB, head0['score_wrgb'], KEY0)
+  if first:
+    ## dummy MAC
+    s.add(mac, head0['score_mac'][0][:vc0], KEY0)
+  s.add(BARRIER, barrier, NONE)
+
+  length = score_length
+  for j in range(0, length+1):
+    if not j == length:
+      s.add(mac, head0['score_mac'][j*16:(j+1)*16], KEY0)
+    if not j == 0:
+      s.add(MVSB, head0['score_mvsb'][j-1], KEY0)
+    if not j == length:
+      stride = _wrgb_stride(pim_type, dhead, n_mac, vc1, length)
+      s.add(WRGB, head1['score_wrgb'][j*stride:(j+1)*stride], KEY1)
+      s.add(BARRIER, barrier, NONE)
+
+  # Head0: SoftMax, Head1: Score
+  half = math.floor(length/2)
+  for j in range(0, length+1):
+    if not j == length:
+      s.add(mac, head1['score_mac'][j*16:(j+1)*16], KEY1)
+    if not j == 0:
+      s.add(MVSB, head1['score_mvsb'][j-1], KEY1)
+    if j == 0:
+      s.add(SFM, head0['sfm'], NONE)
+    if not j == length:
+      if j >= half:
+        stride = _mvgb_stride(pim_type, L, n_mac, vc0, length)
+        s.add(MVGB, head0['context_mvgb'][(j-half)*stride:(j-half+1)*stride], VAL0)
+      s.add(BARRIER, barrier, NONE)
+
+  # Head0: Context, Head1: Softmax
+  length = context_length
+  half = math.floor(length/2)
+  for j in range(0, length+1):
+    if not j == length:
+      s.add(mac, head0['context_mac'][j], VAL0)
+    if not j == 0:
+      s.add(MVSB, head0['context_mvsb'][j-1], VAL0)
+    if j == 0:
+      s.add(SFM, head1['sfm'], NONE)
+    if not j == length:
+      if j >= half:
+        stride = _mvgb_stride(pim_type, L, n_mac, vc1, length)
+        s.add(MVGB, head1['context_mvgb'][(j-half)*stride:(j-half+1)*stride], VAL1)
+      s.add(BARRIER, barrier, NONE)
+
+  # Head1: Context (issued with the commands of head0, as in the reference generators)
+  for j in range(0, length+1):
+    if not j == length:
+      s.add(mac, head0['context_mac'][j], VAL0)
+    if not j == 0:
+      s.add(MVSB, head0['context_mvsb'][j-1], VAL0)
+    if not j == length:
+      s.add(BARRIER, barrier, NONE)
+
+  s.flush()
+
+
+def single_schedule(pim_type, L, dhead, n_mac, head, sink):
+  s = Schedule(MAC_CMD[pim_type], sink)
+  mac = s.mac_cmd
+  barrier = _steps(n_channel, HBM_GS['ch'])
+  score_length, context_length = _lengths(pim_type, L, dhead, n_mac)
+
+  # Score
+  s.add(WRGB, head['score_wrgb'], KEY0)
+  s.add(BARRIER, barrier, NONE)
+  length = score_length
+  for j in range(0, length+1):
+    if not j == length:
+      s.add(mac, head['score_mac'][j*16:(j+1)*16], KEY0)
+    if not j == 0:
+      s.add(MVSB, head['score_mvsb'][j-1], KEY0)
+    if not j == length:
+      s.add(BARRIER, barrier, NONE)
+
+  # SoftMax
+  s.add(SFM, head['sfm'], NONE)
+  s.add(MVGB, head['context_mvgb'], VAL0)
+  s.add(BARRIER, barrier, NONE)
+
+  # Context
+  length = context_length
+  for j in range(0, length+1):
+    if not j == length:
+      s.add(mac, head['context_mac'][j], VAL0)
+    if not j == 0:
+      s.add(MVSB, head['context_mvsb'][j-1], VAL0)
+    if not j == length:
+      s.add(BARRIER, barrier, NONE)
+
+  s.flush()
+
+
+def _write_blocks(trace_file, schedule, offsets):
+  ## offsets: (num_blocks, 5) address offsets of consecutive blocks sharing a schedule
+  ## at most CHUNK_CMDS commands are formatted at once, a long schedule is split
+  codes, bases, sels = schedule
+  per_chunk = max(1, CHUNK_CMDS // len(bases))
+  for start in range(0, len(offsets), per_chunk):
+    offs = offsets[start:start + per_chunk]
+    for lo in range(0, len(bases), CHUNK_CMDS):
+      hi = lo + CHUNK_CMDS
+      addrs = bases[None, lo:hi] + offs[:, sels[lo:hi]]
+      trace_file.write(format_commands(np.tile(codes[lo:hi], len(offs)), addrs.ravel()))
+  return len(bases) * len(offsets)
+
+
+def _write_group(trace_file, schedule, offsets):
+  ## schedule(sink) passes the schedule of consecutive blocks to sink in pieces.
+  ## A schedule of one piece is formatted for all blocks at once, a longer one
+  ## is streamed block by block and built again for each block.
+  first = None
+  streamed = False
+  num_cmds = 0
+  def first_block(piece):
+    nonlocal first, streamed, num_cmds
+    if first is None and not streamed:
+      first = piece
+      return
+    if not streamed:
+      num_cmds += _write_blocks(trace_file, first, offsets[:1])
+      first = None
+      streamed = True
+    num_cmds += _write_blocks(trace_file, piece, offsets[:1])
+  schedule(first_block)
+  if not streamed:
+    return 0 if first is None else _write_blocks(trace_file, first, offsets)
+
+  for block in range(1, len(offsets)):
+    def next_block(piece, block=block):
+      nonlocal num_cmds
+      num_cmds += _write_blocks(trace_file, piece, offsets[block:block + 1])
+    schedule(next_block)
+  return num_cmds
+
+
+# n_head and n_req = n_req per a HBM, returns the number of commands
+def run_attention(pim_type, dhead, n_head_per_hbm, L, trace_file_name, dbyte=2, max_L=4096):
+  n_mac = int(HBM_GS['col'] / dbyte)
+  partition_size = math.ceil(max_L * dhead / (n_pch * n_rank * n_bg * n_bank))
+  v_offset = pow(2, 23)
+
+  num_itr = math.ceil(n_head_per_hbm / (n_channel))
+  valid_channels = []
+  for itr in range(num_itr):
+    remainder = 0
+    if (n_head_per_hbm / ((itr+1) * n_channel) < 1):
+      remainder = n_head_per_hbm % n_channel
+    valid_channels.append(n_channel if remainder == 0 else remainder)
+
+  heads = {}
+  def head(vc):
+    if vc not in heads:
+      heads[vc] = Attention(pim_type, L, dhead, n_mac, vc)
+    return heads[vc]
+
+  def offsets(itrs):
+    key = np.asarray(itrs, dtype=np.int64) * partition_size
+    zero = np.zeros_like(key)
+    return np.stack([zero, key, key + v_offset, key + partition_size,
+                     key + partition_size + v_offset], axis=1)
+
+  ## consecutive head pairs sharing (vc0, vc1, first) share one schedule
+  groups = []
+  for i in range(0, num_itr - 1, 2):
+    key = (valid_channels[i], valid_channels[i+1], i == 0)
+    if groups and groups[-1][0] == key:
+      groups[-1][1].append(i)
+    else:
+      groups.append((key, [i]))
+
+  num_cmds = 0
+  with open(trace_file_name, 'wb') as trace_file:
+    for (vc0, vc1, first), itrs in groups:
+      def schedule(sink, vc0=vc0, vc1=vc1, first=first):
+        pair_schedule(pim_type, L, dhead, n_mac, head(vc0), head(vc1), vc0, vc1, first, sink)
+      num_cmds += _write_group(trace_file, schedule, offsets(itrs))
+
+    if num_itr % 2 != 0:
+      i = num_itr - 1
+      def schedule(sink):
+        single_schedule(pim_type, L, dhead, n_mac, head(valid_channels[i]), sink)
+      num_cmds += _write_group(trace_file, schedule, offsets([i]))
+
+  return num_cmds
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Output path and operation infos",
+                               formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+  parser.add_argument("-p", "--pim", type=str, default="bank", choices=PIM_TYPES,
+                      help="PIM type, default= bank")
+  parser.add_argument("-dh", "--dhead", type=int, default=128,
+                      help="dhead, default= 128")
+  parser.add_argument("-nh", "--nhead", type=int, default=64,
+                      help="Number of heads, default=64")
+  parser.add_argument("-l", "--seqlen", type=int, default=2048,
+                      help="Sequence length L, default= 2048")
+  parser.add_argument("-maxl", "--maxlen", type=int, default=4096,
+                      help="maximum L, default= 4096")
+  parser.add_argument("-db", "--dbyte", type=int, default=2,
+                      help="data type (B), default= 2")
+  parser.add_argument("-o", "--output", type=str, default=None,
+                      help="output path, default= attacc_<pim>.trace")
+
+  args = parser.parse_args()
+  if args.output is None:
+    args.output = "attacc_{}.trace".format(args.pim)
+
+  print("------   Make a trace of {}-level AttAcc (vectorized)   ------".format(args.pim))
+
+  args_dict = vars(args)
+  print("All Arguments:")
+  for key, value in args_dict.items():
+      print(f"     {key}: {value}")
+  print("---------------------------------------------------")
+  run_attention(args.pim, args.dhead, args.nhead, args.seqlen, args.output, args.dbyte,
+                args.maxlen)
+
+
+if __name__ == "__main__":
+  main()
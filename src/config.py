@@ -201,21 +201,23 @@ def make_pim_config(pim_type: PIMType,
     return config
 
 
+## ndec, hdim, nheads, dhead, ff_scale, gqa_size
+MODEL_TABLE = {}
+MODEL_TABLE['GPT-175B'] = [96, 12288, 96, 128, 4, 1]
+MODEL_TABLE['GPT-89B'] = [48, 12288, 96, 128, 4, 1]
+MODEL_TABLE['GPT-13B'] = [40, 5120, 40, 128, 4, 1]
+MODEL_TABLE['LLAMA-7B'] = [32, 4096, 32, 128, 8 / 3, 1]
+MODEL_TABLE['LLAMA-65B'] = [80, 8192, 64, 128, 8 / 3, 1]
+MODEL_TABLE['MT-76B'] = [60, 10240, 40, 128, 4, 1]
+MODEL_TABLE['MT-146B'] = [80, 12288, 80, 128, 4, 1]
+MODEL_TABLE['MT-310B'] = [96, 16384, 128, 128, 4, 1]
+MODEL_TABLE['MT-530B'] = [105, 20480, 128, 160, 4, 1]
+MODEL_TABLE['MT-1008B'] = [128, 25600, 160, 160, 4, 1]
+MODEL_TABLE['OPT-66B'] = [64, 9216, 72, 128, 4, 1]
+
+
 def make_model_config(name, dtype):
-    model_table = {}
-    model_table['GPT-175B'] = [96, 12288, 96, 128, 4, 1]
-    model_table['GPT-89B'] = [48, 12288, 96, 128, 4, 1]
-    model_table['GPT-13B'] = [40, 5120, 40, 128, 4, 1]
-    model_table['LLAMA-7B'] = [32, 4096, 32, 128, 8 / 3, 1]
-    model_table['LLAMA-65B'] = [80, 8192, 64, 128, 8 / 3, 1]
-    model_table['MT-76B'] = [60, 10240, 40, 128, 4, 1]
-    model_table['MT-146B'] = [80, 12288, 80, 128, 4, 1]
-    model_table['MT-310B'] = [96, 16384, 128, 128, 4, 1]
-    model_table['MT-530B'] = [105, 20480, 128, 160, 4, 1]
-    model_table['MT-1008B'] = [128, 25600, 160, 160, 4, 1]
-    model_table['OPT-66B'] = [64, 9216, 72, 128, 4, 1]
-
-    ndec, hdim, nheads, dhead, ff_scale, gqa_size = model_table[name]
+    ndec, hdim, nheads, dhead, ff_scale, gqa_size = MODEL_TABLE[name]
     config = {
         'name': name,
         'ndec': ndec,
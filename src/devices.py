@@ -1,12 +1,184 @@
 from src.type import *
 from src.model import *
+import numpy as np
 import math
+import atexit
+import csv
+import io
+import os
+from collections import OrderedDict
 from src.ramulator_wrapper import *
 
+TILE_COLUMNS = [
+    'num_core', 'l1_cache_size', 'l2_cache_size', 'type', 'm', 'n', 'k',
+    'numOp', 'dbyte', 'l1_tm', 'l1_tn', 'l1_tk', 'l2_tm', 'l2_tn', 'l2_tk'
+]
+NUM_TILE_KEYS = 9
+## new tiles are appended to the file in batches
+TILE_FLUSH = 1024
+
+## tile tables of the process, one per file
+TILE_TABLES = {}
+## layer costs kept per device
+COST_CACHE_SIZE = 65536
+
+
+def _number(text):
+    # shapes and tiles are ints, or floats for the models with a
+    # non-integral ff_scale
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def open_tile_table(path):
+    # shared by all xPU instances of the process using the same file
+    if path not in TILE_TABLES:
+        TILE_TABLES[path] = TileTable(path)
+        atexit.register(TILE_TABLES[path].flush)
+    return TILE_TABLES[path]
+
+
+class TileTable:
+    # tiles found by xPU._optimal_tile(), keyed by the device parameters the
+    # search depends on and the layer shape. The file is append-only and
+    # shared by concurrent processes (e.g., sweep workers), it is read
+    # lazily on the first lookup and again on each miss.
+
+    def __init__(self, path):
+        self.path = path
+        self.tiles = {}
+        self.pending = []
+        self.offset = 0
+        self.inode = None
+
+    def refresh(self):
+        # read the rows appended by this or other processes
+        if not os.path.exists(self.path):
+            return
+        stat = os.stat(self.path)
+        if stat.st_ino == self.inode and stat.st_size == self.offset:
+            return
+        with open(self.path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if self.inode is not None and (stat.st_ino != self.inode or
+                                           stat.st_size < self.offset):
+                # the file was rewritten
+                self.offset = 0
+            f.seek(self.offset)
+            data = f.read()
+        self.inode = stat.st_ino
+
+        # an incomplete last line is read on the next refresh
+        nbytes = data.rfind(b'\n') + 1
+        if nbytes == 0:
+            return
+        if self.offset == 0:
+            df = pd.read_csv(io.BytesIO(data[:nbytes]),
+                             float_precision='round_trip')
+            rows = zip(*[df[c].tolist() for c in TILE_COLUMNS])
+        else:
+            rows = ([row[3] if i == 3 else _number(v)
+                     for i, v in enumerate(row)]
+                    for row in csv.reader(io.StringIO(data[:nbytes].decode()))
+                    if len(row) == len(TILE_COLUMNS) and
+                    row[0] != TILE_COLUMNS[0])
+        for row in rows:
+            self.tiles.setdefault(tuple(row[:NUM_TILE_KEYS]),
+                                  list(row[NUM_TILE_KEYS:]))
+        self.offset += nbytes
+
+    def lookup(self, key):
+        if key not in self.tiles:
+            self.refresh()
+        tiles = self.tiles.get(key)
+        return None if tiles is None else list(tiles)
+
+    def update(self, key, tiles):
+        self.tiles[key] = list(tiles)
+        self.pending.append(key)
+        if len(self.pending) >= TILE_FLUSH:
+            self.flush()
+
+    def flush(self):
+        # append the new tiles, skipping those other processes appended
+        if len(self.pending) == 0:
+            return
+        with file_lock(lock_path(self.path)):
+            pending = {key: self.tiles.pop(key) for key in self.pending}
+            self.pending = []
+            self.refresh()
+            line = io.StringIO()
+            wrt = csv.writer(line, lineterminator='\n')
+            if not os.path.exists(self.path) or os.path.getsize(
+                    self.path) == 0:
+                wrt.writerow(TILE_COLUMNS)
+            for key, tiles in pending.items():
+                if key not in self.tiles:
+                    wrt.writerow(list(key) + tiles)
+                    self.tiles[key] = tiles
+            data = line.getvalue().encode()
+            with open(self.path, 'ab') as f:
+                f.write(data)
+            # rows are appended whole under the lock, so the file was read
+            # up to its end
+            self.offset += len(data)
+            self.inode = os.stat(self.path).st_ino
+
+
+class CostCache:
+    # LRU memoization of get_time_and_energy() per device, keyed by the
+    # layer type, name (the flops of an activation and the attention phase
+    # depend on it) and shape. The layer attributes the cost sets (e.g.,
+    # the bound used by _ff_parallel) are restored on a hit.
+
+    def __init__(self, attributes, size=COST_CACHE_SIZE):
+        self.attributes = attributes
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, layer: Layer):
+        return (layer.type, layer.name) + layer.get_infos()
+
+    def lookup(self, layer: Layer):
+        entry = self.entries.get(self.key(layer))
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(self.key(layer))
+        exec_time, energy, attributes = entry
+        for name, value in attributes:
+            setattr(layer, name, value)
+        return exec_time, list(energy)
+
+    def store(self, layer: Layer, exec_time, energy):
+        attributes = [(name, getattr(layer, name))
+                      for name in self.attributes(layer)]
+        self.entries[self.key(layer)] = (exec_time, list(energy), attributes)
+        self.entries.move_to_end(self.key(layer))
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def get(self, layer: Layer, cost):
+        cached = self.lookup(layer)
+        if cached is not None:
+            return cached
+        exec_time, energy = cost(layer)
+        self.store(layer, exec_time, energy)
+        return exec_time, energy
+
 
 class xPU:
 
-    def __init__(self, name: DeviceType, config, scaling_factor):
+    def __init__(self,
+                 name: DeviceType,
+                 config,
+                 scaling_factor,
+                 tile_table=None):
         self.name = name
         self.gpu_type = None
         if self.name == DeviceType.GPU:
@@ -28,49 +200,77 @@ class xPU:
         self.energy_table = config['ENERGY_TABLE']
 
         self.table_tiles = {}
+        self.tile_table = None
+        if tile_table is not None:
+            self.tile_table = open_tile_table(tile_table)
+        self.cost_cache = CostCache(self._cost_attributes)
 
     def _get_traffic_for_tile(self, tm, tn, layer: Layer):
-        m, n, k, numOp, dbyte = layer.get_infos()
+        return self._tile_traffic(tm, tn, *layer.get_infos())
+
+    def _tile_traffic(self, tm, tn, m, n, k, numOp, dbyte):
         traffic = [math.ceil(n / tn) * m * k, math.ceil(m / tm) * n * k, m * n]
         traffic = [i * dbyte * numOp for i in traffic]
         return traffic
 
     def _get_optimal_tile(self, layer: Layer):
-        m, n, k, numOp, dbyte = layer.get_infos()
+        return self._cached_tile(layer.type, *layer.get_infos())
+
+    def _cached_tile(self, type, m, n, k, numOp, dbyte):
+        # _optimal_tile() memoized in memory and in the tile table
         config = (m, n, k, numOp, dbyte)
         if config in self.table_tiles.keys():
             return self.table_tiles[config]
+        table_key = (self.num_core, self.l1_cache_size, self.l2_cache_size,
+                     type.name) + config
+        if self.tile_table is not None:
+            out_tiles = self.tile_table.lookup(table_key)
+            if out_tiles is not None:
+                self.table_tiles[config] = out_tiles
+                return out_tiles
+        out_tiles = self._optimal_tile(type, *config)
+        self.table_tiles[config] = out_tiles
+        if self.tile_table is not None:
+            self.tile_table.update(table_key, out_tiles)
+        return out_tiles
+
+    def _optimal_tile(self, type, m, n, k, numOp, dbyte):
+        def ceil_div(a, b):
+            # math.ceil(a / b)
+            return np.ceil(a / b).astype(np.int64)
+
+        def tile_traffic(tm, tn):
+            # sum(self._tile_traffic(tm, tn, ...))
+            return (ceil_div(n, tn) * m * k * dbyte * numOp +
+                    ceil_div(m, tm) * n * k * dbyte * numOp +
+                    m * n * dbyte * numOp)
 
         trange = [8, 16, 32, 64, 128, 192, 256, 320, 384, 448, 512]
 
         # find L1 tile size
-        l1_tm = 0
-        l1_tn = 0
+        ## the whole trange x trange grid at once, the first minimum wins
         l1_tk = 32
+        l1_tm = np.minimum(np.repeat(trange, len(trange)), m)
+        l1_tn = np.minimum(np.tile(trange, len(trange)), n)
+        required_capacity = (
+            l1_tm + l1_tn) * l1_tk * dbyte + l1_tm * l1_tn * dbyte
+        l2_access = tile_traffic(l1_tm, l1_tn)
+
+        ## applying SM underutilization to cost function
+        num_threadblock = numOp
+        if type == LayerType.FC:
+            num_threadblock = ceil_div(m, l1_tm) * ceil_div(n, l1_tn) * numOp
+        tmp = ceil_div(num_threadblock, self.num_core) * self.num_core
+        core_utilization = num_threadblock / tmp
+        cost = l2_access * (1 / core_utilization)**2
+        cost = np.where(required_capacity > self.l1_cache_size, np.inf, cost)
         opt_config = [0, 0]
-        min_cost = float('inf')
-        for l1_tm in trange:
-            for l1_tn in trange:
-                l1_tm = min(l1_tm, m)
-                l1_tn = min(l1_tn, n)
-                required_capacity = (
-                    l1_tm + l1_tn) * l1_tk * dbyte + l1_tm * l1_tn * dbyte
-                if required_capacity > self.l1_cache_size:
-                    continue
-                l2_access = sum(self._get_traffic_for_tile(l1_tm, l1_tn, layer))
-
-                ## applying SM underutilization to cost function
-                num_threadblock = numOp
-                if layer.type == LayerType.FC:
-                    num_threadblock = math.ceil(m / l1_tm) * math.ceil(
-                        n / l1_tn) * numOp
-
-                tmp = math.ceil(num_threadblock / self.num_core) * self.num_core
-                core_utilization = num_threadblock / tmp
-                cost = l2_access * pow((1 / core_utilization), 2)
-                if cost < min_cost:
-                    min_cost = cost
-                    opt_config = [l1_tm, l1_tn]
+        if np.isfinite(cost).any():
+            i = int(np.argmin(cost))
+            opt_config = [
+                min(trange[i // len(trange)], m),
+                min(trange[i % len(trange)], n)
+            ]
 
         l1_tm, l1_tn = opt_config
 
@@ -78,30 +278,45 @@ class xPU:
         ## experimentally found L2 tile_k size
         l2_tk = k / 64
 
-        min_access = float('inf')
-        opt_config = [0, 0]
-        for l2_tm in [l1_tm * i for i in range(1, int(m / l1_tm) + 1)] + [m]:
-            for l2_tn in [l1_tn * i for i in range(1,
-                                                   int(n / l1_tn) + 1)] + [n]:
-                l2_tm = min(l2_tm, m)
-                l2_tn = min(l2_tn, n)
-                required_capacity = (
-                    l2_tm + l2_tn) * l2_tk * dbyte + l2_tm * l2_tn * dbyte
-                if required_capacity > self.l2_cache_size:
-                    if l2_tm != l1_tm or l2_tn != l1_tn:
-                        continue
-
-                access = math.ceil(m / l2_tm) * n * k * dbyte + \
-                          math.ceil(n / l2_tn) * m * k * dbyte + m * n * dbyte
-
-                if access < min_access:
-                    min_access = access
-                    opt_config = [l2_tm, l2_tn]
-
-        l2_tm, l2_tn = opt_config
-        out_tiles = [l1_tm, l1_tn, l1_tk, l2_tm, l2_tn, l2_tk]
-        self.table_tiles[config] = out_tiles
-        return out_tiles
+        ## candidates: the multiples of the L1 tile and the full size. The
+        ## capacity grows and the access shrinks with l2_tn, so each l2_tm
+        ## fits a prefix of the l2_tn and its last one has the least access.
+        num_tm = int(m / l1_tm)
+        num_tn = int(n / l1_tn)
+        l2_tms = np.minimum(
+            np.append(l1_tm * np.arange(1, num_tm + 1), m), m)
+        l2_tns = np.minimum(
+            np.append(l1_tn * np.arange(1, num_tn + 1), n), n)
+
+        def fits(tm, tn):
+            required_capacity = (tm + tn) * l2_tk * dbyte + tm * tn * dbyte
+            return required_capacity <= self.l2_cache_size
+
+        def access(tm, tn):
+            return ceil_div(m, tm) * n * k * dbyte + \
+                   ceil_div(n, tn) * m * k * dbyte + m * n * dbyte
+
+        ## number of l2_tn that fit, by bisection for all l2_tm at once
+        lo = np.zeros(len(l2_tms), dtype=np.int64)
+        hi = np.full(len(l2_tms), len(l2_tns), dtype=np.int64)
+        while (lo < hi).any():
+            active = lo < hi
+            mid = (lo + hi) // 2
+            ok = fits(l2_tms, l2_tns[np.minimum(mid, len(l2_tns) - 1)])
+            lo = np.where(active & ok, mid + 1, lo)
+            hi = np.where(active & ~ok, mid, hi)
+        ## the L1 tile is taken even if it does not fit
+        num_fit = np.where(l2_tms == l1_tm, np.maximum(lo, 1), lo)
+
+        row_access = np.where(
+            num_fit > 0, access(l2_tms, l2_tns[np.maximum(num_fit - 1, 0)]),
+            np.inf)
+        row = int(np.argmin(row_access))
+        j = int(np.argmin(access(l2_tms[row], l2_tns[:num_fit[row]])))
+
+        l2_tm = min(l1_tm * (row + 1), m) if row < num_tm else m
+        l2_tn = min(l1_tn * (j + 1), n) if j < num_tn else n
+        return [l1_tm, l1_tn, l1_tk, l2_tm, l2_tn, l2_tk]
 
     def _get_traffic(self, layer: Layer):
         # return tuple of 4 elements (off-mem, L2, L1, reg)
@@ -259,12 +474,161 @@ class xPU:
             energy = self.num_xpu * traffic * self.energy_table['comm']
         return exec_time, [0, 0, 0, 0, 0, energy]
 
+    def _cost_attributes(self, layer: Layer):
+        # layer attributes set by get_time_and_energy()
+        if layer.type in [LayerType.X2G, LayerType.G2G]:
+            return []
+        return ['bound', 'time', 'off_traffic']
+
     def get_time_and_energy(self, layer: Layer):
+        return self.cost_cache.get(layer, self._time_and_energy)
+
+    def _time_and_energy(self, layer: Layer):
         if layer.type in [LayerType.X2G, LayerType.G2G]:
             return self._io_time_energy(layer)
         else:
             return self._exec_time(layer), self._get_energy(layer)
 
+    def get_times_and_energies(self, layers):
+        # get_time_and_energy() of many layers, the layers missing in the
+        # cost cache are costed in one vectorized pass
+        costs = [self.cost_cache.lookup(layer) for layer in layers]
+        missing = [layer for layer, cost in zip(layers, costs) if cost is None]
+        if len(missing) == 0:
+            return costs
+        times, bounds, energies, off_traffic = self.cost_arrays(
+            **layer_arrays(missing))
+        times = times.tolist()
+        energies = energies.tolist()
+        off_traffic = off_traffic.tolist()
+        for i, layer in enumerate(missing):
+            if bounds[i] is not None:
+                layer.bound = bounds[i]
+                layer.time = times[i]
+                layer.off_traffic = off_traffic[i]
+            self.cost_cache.store(layer, times[i], energies[i])
+        computed = iter(zip(times, energies))
+        return [next(computed) if cost is None else cost for cost in costs]
+
+    def cost_arrays(self, types, m, n, k, numOp, dbyte, flops, size):
+        # vectorized _exec_time(), _get_energy() and _io_time_energy() of
+        # layers given as arrays (see layer_arrays()). Returns the times, the
+        # bounds (None for the io layers, which have none), the energies
+        # (one row of six per layer) and the off-chip traffic.
+        gemm = np.isin(types, [LayerType.FC.value, LayerType.MATMUL.value])
+        io = np.isin(types, [LayerType.G2G.value, LayerType.X2G.value])
+
+        def ceil_div(a, b):
+            # math.ceil(a / b)
+            return np.ceil(a / b).astype(np.int64)
+
+        # one tile search per distinct shape, in the order of the layers
+        l1_tm = np.ones(len(types))
+        l1_tn = np.ones(len(types))
+        l2_tm = np.ones(len(types))
+        l2_tn = np.ones(len(types))
+        if gemm.any():
+            rows = np.rec.fromarrays(
+                [a[gemm] for a in [types, m, n, k, numOp, dbyte]])
+            _, first, inverse = np.unique(rows,
+                                          return_index=True,
+                                          return_inverse=True)
+            shapes = [
+                a[gemm][first].tolist() for a in [types, m, n, k, numOp, dbyte]
+            ]
+            tiles = np.zeros((len(first), 4))
+            for i in np.argsort(first):
+                type, *infos = [shape[i] for shape in shapes]
+                tile = self._cached_tile(LayerType(type), *infos)
+                tiles[i] = [tile[0], tile[1], tile[3], tile[4]]
+            tiles = tiles[inverse.reshape(-1)]
+            l1_tm[gemm], l1_tn[gemm] = tiles[:, 0], tiles[:, 1]
+            l2_tm[gemm], l2_tn[gemm] = tiles[:, 2], tiles[:, 3]
+
+        def tile_traffic(tm, tn):
+            return (ceil_div(n, tn) * m * k * dbyte * numOp +
+                    ceil_div(m, tm) * n * k * dbyte * numOp +
+                    m * n * dbyte * numOp)
+
+        off_data = np.where(gemm, tile_traffic(l2_tm, l2_tn), size)
+        l2_data = np.where(gemm, tile_traffic(l1_tm, l1_tn), size)
+        l1_data = np.where(gemm, tile_traffic(16, 16), size)
+        reg_data = np.where(gemm, 3 * (m * n * k), size)
+
+        # time
+        num_threadblock = np.where(types == LayerType.FC.value,
+                                   ceil_div(m, l1_tm) * ceil_div(n, l1_tn) *
+                                   numOp, numOp)
+        tmp = ceil_div(num_threadblock, self.num_core) * self.num_core
+        core_utilization = num_threadblock / tmp
+
+        peak_flops = self.peak_flops * self.max_compute_util
+        if self.name == DeviceType.GPU:
+            peak_flops = peak_flops * core_utilization
+        peak_flops = peak_flops * (2 // dbyte)
+        compute_time = flops / peak_flops
+
+        mem_bw = self.peak_memory_bandwidth * self.max_memory_util
+        if self.name == DeviceType.GPU:
+            mem_time = np.maximum(off_data / (mem_bw * core_utilization),
+                                  l2_data / self.peak_l2_bandwidth)
+            bw_scale = 1555 * 1000 * 1000 * 1000 / self.peak_memory_bandwidth
+            act_time = (0.000000447 * bw_scale * off_data +
+                        8.29) / 1000 / 1000
+            norm_time = (0.0000016 * bw_scale * off_data +
+                         6.87) / 1000 / 1000
+            mem_time = np.where(types == LayerType.ACT.value,
+                                np.maximum(act_time, 0), mem_time)
+            mem_time = np.where(types == LayerType.NORM.value,
+                                np.maximum(norm_time, 0), mem_time)
+        else:
+            mem_time = np.maximum(off_data / mem_bw,
+                                  l2_data / self.peak_l2_bandwidth)
+
+        compute_bound = compute_time > mem_time
+        times = np.where(compute_bound, compute_time, mem_time)
+        bounds = np.where(compute_bound, 'compute', 'memory').astype(object)
+
+        # energy
+        energies = np.zeros((len(types), 6))
+        if self.name == DeviceType.CPU:
+            energies[:, 0] = off_data * self.energy_table['mem']
+        else:
+            energies[:, 0] = off_data * self.energy_table['mem']
+            energies[:, 1] = l2_data * self.energy_table['l2']
+            energies[:, 2] = l1_data * self.energy_table['l1']
+            energies[:, 3] = reg_data * self.energy_table['reg']
+        energies[:, 4] = flops / 2 * self.energy_table['alu']
+        energies = energies * self.num_xpu
+
+        # io layers
+        if io.any():
+            traffic = m * n * numOp * dbyte
+            interface_bw = self.max_interface_bandwidth / 2
+            io_energy = np.zeros((len(types), 6))
+            if self.name == DeviceType.CPU:
+                io_time = traffic / interface_bw
+            else:
+                ## allreduce, see get_nvlink_time() in _io_time_energy()
+                size_ = traffic / self.num_xpu
+                approx_ns_time = 6060 + 0.009 * size_ * (
+                    (600 * 1000 * 1000 * 1000 / self.max_interface_bandwidth))
+                approx_time = approx_ns_time / 1000 / 1000 / 1000
+                nvlink_time = np.where(
+                    size_ == 0, 1,
+                    np.maximum(approx_time,
+                               size_ / (self.max_interface_bandwidth / 2)))
+                io_time = np.where(types == LayerType.X2G.value,
+                                   traffic / interface_bw,
+                                   nvlink_time * (self.num_xpu - 1))
+                io_energy[:, 5] = self.num_xpu * traffic * self.energy_table[
+                    'comm']
+            times = np.where(io, io_time, times)
+            energies = np.where(io[:, None], io_energy, energies)
+            bounds[io] = None
+
+        return times, bounds, energies, off_data
+
 
 class PIM:
 
@@ -283,6 +647,7 @@ class PIM:
         self.io_energy_table = self.energy_table['io']
         self.power_constraint = config['POWER_CONSTRAINT']
         self.ramulator = ramulator
+        self.cost_cache = CostCache(self._cost_attributes)
 
     def _get_traffic(self, layer: Layer):
         # return tuple of 4 elements (off-mem, L2, L1, reg)
@@ -323,7 +688,63 @@ class PIM:
 
         return [e_off, 0, 0, 0, e_flop, 0]
 
+    def _attention_energy(self, layer: Layer, traffic):
+        io_energy = 0
+        for i in range(len(self.io_energy_table)):
+            io_energy += traffic[i] * self.io_energy_table[i]
+
+        energy_per_access = self.energy_table['mem']
+        cell_energy = traffic[-1] * energy_per_access
+        dram_energy = cell_energy + io_energy
+        cal_energy = layer.get_flops() / 2 * self.energy_table['alu']
+
+        energies = [dram_energy, 0, 0, 0, cal_energy, 0]
+        energies = [i * self.num_attacc for i in energies]
+        return energies
+
+    def _score_layer(self, layer: Layer):
+        # score layer of the attention a context layer belongs to
+        return Layer(layer.stage, 'score', LayerType.MATMUL, False,
+                     layer.dtype, layer.m, layer.k, layer.n, layer.numOp)
+
+    def get_energy(self, layer: Layer):
+        # energy of get_time_and_energy() without running Ramulator,
+        # the attention traffic follows from the command counts of the trace
+        if layer.type == LayerType.X2G:
+            return self._io_time_energy(layer)[1]
+        elif layer.type == LayerType.MATMUL:
+            if 'score' in layer.name:
+                traffic = self.ramulator.traffic(self.pim_type, layer)
+                return self._attention_energy(layer, traffic)
+            else:
+                return [0, 0, 0, 0, 0, 0]
+        elif layer.type == LayerType.SOFTMAX:
+            return self._get_energy(layer)
+        else:
+            assert 0, "PIM does not support this layer."
+
+    def prefetch(self, layers):
+        # run Ramulator for every score layer not in the cache at once
+        score_layers = (
+            layer for layer in layers
+            if layer.type == LayerType.MATMUL and 'score' in layer.name)
+        self.ramulator.prefetch(self.pim_type, score_layers,
+                                self.power_constraint)
+
+    def get_times_and_energies(self, layers):
+        # the attention costs come from the Ramulator cache one by one
+        return [self.get_time_and_energy(layer) for layer in layers]
+
+    def _cost_attributes(self, layer: Layer):
+        # layer attributes set by get_time_and_energy()
+        if layer.type == LayerType.SOFTMAX:
+            return ['bound', 'time']
+        return []
+
     def get_time_and_energy(self, layer: Layer):
+        return self.cost_cache.get(layer, self._time_and_energy)
+
+    def _time_and_energy(self, layer: Layer):
         if layer.type == LayerType.X2G:
             return self._io_time_energy(layer)
 
@@ -333,19 +754,21 @@ class PIM:
                 m, n, k, numOp, dbyte = layer.get_infos()
                 time, traffic = self.ramulator.output(
                     self.pim_type, layer, self.power_constraint)
-                io_energy = 0
-                for i in range(len(self.io_energy_table)):
-                    io_energy += traffic[i] * self.io_energy_table[i]
-
-                energy_per_access = self.energy_table['mem']
-                cell_energy = traffic[-1] * energy_per_access
-                dram_energy = cell_energy + io_energy
-                cal_energy = layer.get_flops() / 2 * self.energy_table['alu']
-
-                energies = [dram_energy, 0, 0, 0, cal_energy, 0]
-                energies = [i * self.num_attacc for i in energies]
-
-                return time, energies
+                split = self.ramulator.phase_split(self.pim_type, layer,
+                                                   self.power_constraint)
+                if split is not None:
+                    # the context phase is charged to the context layer
+                    time *= split[0] + split[1]
+                return time, self._attention_energy(layer, traffic)
+            elif 'context' in layer.name:
+                score = self._score_layer(layer)
+                split = self.ramulator.phase_split(self.pim_type, score,
+                                                   self.power_constraint)
+                if split is None:
+                    return 0, [0, 0, 0, 0, 0, 0]
+                time, _ = self.ramulator.output(self.pim_type, score,
+                                                self.power_constraint)
+                return time * split[2], [0, 0, 0, 0, 0, 0]
             else:
                 return 0, [0, 0, 0, 0, 0, 0]
 
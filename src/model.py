@@ -1,6 +1,7 @@
 ## Define models and layer.
 ## Generate models
 from .type import *
+import numpy as np
 import copy
 
 
@@ -81,6 +82,25 @@ class Layer:
         return in1, in2, out
 
 
+def layer_arrays(layers):
+    # layers as arrays for the vectorized cost engine (xPU.cost_arrays),
+    # the shapes of some models are not integral (e.g. ff_scale of LLAMA)
+    return {
+        'types': np.array([layer.type.value for layer in layers]),
+        'm': np.array([layer.m for layer in layers]),
+        'n': np.array([layer.n for layer in layers]),
+        'k': np.array([layer.k for layer in layers]),
+        'numOp': np.array([layer.numOp for layer in layers]),
+        'dbyte': np.array([layer.dbyte for layer in layers]),
+        'flops': np.array([layer.get_flops() for layer in layers]),
+        'size': np.array([sum(layer.get_size()) for layer in layers])
+    }
+
+
+## layers of a generation stage that depend on the attention length
+STAGE_LAYERS = ['score', 'softmax', 'context']
+
+
 class Transformer:
 
     def __init__(self, modelinfos, tensor_parallel=8):
@@ -96,6 +116,14 @@ class Transformer:
         self.tp = tensor_parallel
 
     def build(self, batch, lin, lout, attn_on_hetero=False):
+        self.build_sum(batch, lin, attn_on_hetero)
+
+        # Generation
+        self.gen_decoder = list(
+            self.gen_stages(batch, lin, lout, attn_on_hetero))
+
+    def build_sum(self, batch, lin, attn_on_hetero=False):
+        # summarization stage only, see gen_stages() for the generation stages
         self.sum_decoder = []
         self.gen_decoder = []
 
@@ -165,83 +193,107 @@ class Transformer:
         self.sum_decoder.append(
             Layer('sum', 'norm2', LayerType.NORM, False, self.dtype, batch * lin,
                   self.hdim, 1, 1))
-        # Generation
-        for stage in range(1, lout, 1):
-            decoder = []
+
+    def gen_stages(self, batch, lin, lout, attn_on_hetero=False,
+                   template=None, stages=None):
+        # lazily yields the decoder block of each generation stage, so only
+        # one stage is alive at a time. With a template block (a gen_block()),
+        # only its STAGE_LAYERS are created per stage and the other layers
+        # are shared by all stages. stages restricts the blocks to the given
+        # stages (1 to lout - 1).
+        if stages is None:
+            stages = range(1, lout, 1)
+        for stage in stages:
+            if template is None:
+                yield self.gen_block(batch, lin, stage, attn_on_hetero)
+            else:
+                attn = {
+                    layer.name: layer
+                    for layer in self.stage_layers(batch, lin, stage)
+                }
+                yield [attn.get(layer.name, layer) for layer in template]
+
+    def gen_block(self, batch, lin, stage, attn_on_hetero=False):
+        # decoder block of a generation stage, only the STAGE_LAYERS depend
+        # on the stage (attention length lin + stage)
+        decoder = []
+        decoder.append(
+            Layer('gen', 'qkv', LayerType.FC, True, self.dtype, batch,
+                  3 * int(self.hdim / self.tp), self.hdim, 1))
+        if (attn_on_hetero):
             decoder.append(
-                Layer('gen', 'qkv', LayerType.FC, True, self.dtype, batch,
-                      3 * int(self.hdim / self.tp), self.hdim, 1))
-            if (attn_on_hetero):
-                decoder.append(
-                    Layer('gen', 'comm_x2g', LayerType.X2G, False, self.dtype,
-                          batch, 3 * int(self.hdim / self.tp), 1, 1))
+                Layer('gen', 'comm_x2g', LayerType.X2G, False, self.dtype,
+                      batch, 3 * int(self.hdim / self.tp), 1, 1))
+        decoder.extend(self.stage_layers(batch, lin, stage))
+        if (attn_on_hetero):
             decoder.append(
-                Layer('gen', 'score', LayerType.MATMUL, False, self.dtype, 1,
-                      lin + stage, self.dhead,
+                Layer('gen', 'comm_x2g', LayerType.X2G, False, self.dtype, 1,
+                      self.dhead, 1,
                       int(self.num_heads / self.tp) * batch))
+        decoder.append(
+            Layer('gen', 'proj', LayerType.FC, True, self.dtype, batch,
+                  self.hdim, int(self.hdim / self.tp), 1))
+        decoder.append(
+            Layer('gen', 'comm_g2g', LayerType.G2G, False, self.dtype, batch,
+                  self.hdim, 1, 1))
+        decoder.append(
+            Layer('gen', 'norm1', LayerType.NORM, False, self.dtype, batch,
+                  self.hdim, 1, 1))
+        if 'LLAMA' in self.name:
             decoder.append(
-                Layer('gen', 'softmax', LayerType.SOFTMAX, False, self.dtype,
-                      1, lin + stage, 1,
-                      int(self.num_heads / self.tp) * batch))
+                Layer('gen', 'ff1', LayerType.FC, True, self.dtype, batch,
+                      self.ff_scale * int(self.hdim / self.tp), self.hdim,
+                      1))
             decoder.append(
-                Layer('gen', 'context', LayerType.MATMUL, False, self.dtype,
-                      1, self.dhead, lin + stage,
-                      int(self.num_heads / self.tp) * batch))
-            if (attn_on_hetero):
-                decoder.append(
-                    Layer('gen', 'comm_x2g', LayerType.X2G, False, self.dtype, 1,
-                          self.dhead, 1,
-                          int(self.num_heads / self.tp) * batch))
+                Layer('gen', 'ff2', LayerType.FC, True, self.dtype, batch,
+                      self.ff_scale * int(self.hdim / self.tp), self.hdim,
+                      1))
             decoder.append(
-                Layer('gen', 'proj', LayerType.FC, True, self.dtype, batch,
-                      self.hdim, int(self.hdim / self.tp), 1))
+                Layer('gen', 'glu', LayerType.ACT, False, self.dtype, batch,
+                      self.ff_scale * int(self.hdim / self.tp), 1, 1))
             decoder.append(
-                Layer('gen', 'comm_g2g', LayerType.G2G, False, self.dtype, batch,
-                      self.hdim, 1, 1))
+                Layer('gen', 'ff3', LayerType.FC, True, self.dtype,
+                      batch, self.hdim,
+                      self.ff_scale * int(self.hdim / self.tp), 1))
+        else:
             decoder.append(
-                Layer('gen', 'norm1', LayerType.NORM, False, self.dtype, batch,
-                      self.hdim, 1, 1))
-            if 'LLAMA' in self.name:
-                decoder.append(
-                    Layer('gen', 'ff1', LayerType.FC, True, self.dtype, batch,
-                          self.ff_scale * int(self.hdim / self.tp), self.hdim,
-                          1))
-                decoder.append(
-                    Layer('gen', 'ff2', LayerType.FC, True, self.dtype, batch,
-                          self.ff_scale * int(self.hdim / self.tp), self.hdim,
-                          1))
+                Layer('gen', 'ff1', LayerType.FC, True, self.dtype, batch,
+                      self.ff_scale * int(self.hdim / self.tp), self.hdim,
+                      1))
+            if 'OPT' in self.name:
                 decoder.append(
-                    Layer('gen', 'glu', LayerType.ACT, False, self.dtype, batch,
+                    Layer('gen', 'relu', LayerType.ACT, False,
+                          self.dtype, batch,
                           self.ff_scale * int(self.hdim / self.tp), 1, 1))
-                decoder.append(
-                    Layer('gen', 'ff3', LayerType.FC, True, self.dtype,
-                          batch, self.hdim,
-                          self.ff_scale * int(self.hdim / self.tp), 1))
             else:
                 decoder.append(
-                    Layer('gen', 'ff1', LayerType.FC, True, self.dtype, batch,
-                          self.ff_scale * int(self.hdim / self.tp), self.hdim,
-                          1))
-                if 'OPT' in self.name:
-                    decoder.append(
-                        Layer('gen', 'relu', LayerType.ACT, False,
-                              self.dtype, batch,
-                              self.ff_scale * int(self.hdim / self.tp), 1, 1))
-                else:
-                    decoder.append(
-                        Layer('gen', 'gelu', LayerType.ACT, False,
-                              self.dtype, batch,
-                              self.ff_scale * int(self.hdim / self.tp), 1, 1))
-                decoder.append(
-                    Layer('gen', 'ff2', LayerType.FC, True, self.dtype,
-                          batch, self.hdim,
-                          self.ff_scale * int(self.hdim / self.tp), 1))
-
-            decoder.append(
-                Layer('gen', 'comm_g2g', LayerType.G2G, False, self.dtype, batch,
-                      self.hdim, 1, 1))
+                    Layer('gen', 'gelu', LayerType.ACT, False,
+                          self.dtype, batch,
+                          self.ff_scale * int(self.hdim / self.tp), 1, 1))
             decoder.append(
-                Layer('gen', 'norm2', LayerType.NORM, False, self.dtype, batch,
-                      self.hdim, 1, 1))
+                Layer('gen', 'ff2', LayerType.FC, True, self.dtype,
+                      batch, self.hdim,
+                      self.ff_scale * int(self.hdim / self.tp), 1))
+
+        decoder.append(
+            Layer('gen', 'comm_g2g', LayerType.G2G, False, self.dtype, batch,
+                  self.hdim, 1, 1))
+        decoder.append(
+            Layer('gen', 'norm2', LayerType.NORM, False, self.dtype, batch,
+                  self.hdim, 1, 1))
+
+        return decoder
 
-            self.gen_decoder.append(copy.deepcopy(decoder))
+    def stage_layers(self, batch, lin, stage):
+        # STAGE_LAYERS of a generation stage
+        return [
+            Layer('gen', 'score', LayerType.MATMUL, False, self.dtype, 1,
+                  lin + stage, self.dhead,
+                  int(self.num_heads / self.tp) * batch),
+            Layer('gen', 'softmax', LayerType.SOFTMAX, False, self.dtype, 1,
+                  lin + stage, 1,
+                  int(self.num_heads / self.tp) * batch),
+            Layer('gen', 'context', LayerType.MATMUL, False, self.dtype, 1,
+                  self.dhead, lin + stage,
+                  int(self.num_heads / self.tp) * batch)
+        ]
@@ -1,11 +1,783 @@
 import pandas as pd
-import subprocess
+import numpy as np
+import argparse
 import math
+import fcntl
+import tempfile
+import importlib.util
+import concurrent.futures
+import asyncio
+import zlib
+import hashlib
+import shutil
+import errno
+import csv
+import io
 import os
+import re
+from contextlib import contextmanager
 from src.config import *
 from src.model import *
 from src.type import *
 
+KEY_COLUMNS = [
+    'L', 'nhead', 'dhead', 'dbyte', 'pim_type', 'power_constraint'
+]
+VALUE_COLUMNS = ['cycle', 'mac', 'softmax', 'mvgb', 'mvsb', 'wrgb']
+## provenance: fingerprint of the Ramulator build, its configuration and the
+## trace generator that produced a row, empty for rows logged before it was
+## recorded (their provenance is unknown, they are accepted by every build)
+LOG_COLUMNS = KEY_COLUMNS + VALUE_COLUMNS + ['provenance']
+NUM_VALUES = len(VALUE_COLUMNS)
+
+## ----------------------------  Snapshot -------------------------------##
+## int64 array: | version | csv bytes | csv crc | n | keys (n) | values (6 x n) |
+##              | provenance (n) |
+## keys are packed cache keys in ascending order, values are stored per column.
+## A key has a row for each provenance of its rows (the first row of the log
+## with that provenance), in log order, so that a lookup selects the same row
+## as Ramulator.index_row() for any build.
+## The snapshot covers the first 'csv bytes' of the log, rows appended later
+## are read from the CSV tail.
+SNAPSHOT_VERSION = 3
+SNAPSHOT_HEADER = 4
+## bits  |  L  | nhead | dhead | dbyte | pim_type | power_constraint |
+##       | 24  |  16   |  12   |   4   |    2     |        1         |
+KEY_BITS = [24, 16, 12, 4, 2, 1]
+CRC_BYTES = 4096
+
+## pipe: the trace generator streams into a named pipe read by Ramulator
+## file: the trace is written to a file first (for debugging)
+TRACE_MODES = ['pipe', 'file']
+TRACE_STORE_SIZE = 10  # GB
+
+## (dhead, heads per HBM, L) of the traces in the provenance of a PIM type,
+## three head iterations with a partial last one
+PROVENANCE_SHAPE = (128, 40, 100)
+
+## (L, heads per HBM) of the fast_mode accuracy report
+REFERENCE_SHAPES = [(l, nhead) for l in [256, 1024, 2048, 4096]
+                    for nhead in [512, 2048]]
+
+
+## ----------------------------  Commands -------------------------------##
+## PIM commands of a trace per legacy channel, in closed form from the loops
+## of trace_gen/gen_trace_attacc_*.py (same order as VALUE_COLUMNS[1:])
+COUNT_COLUMNS = ['mac', 'softmax', 'mvgb', 'mvsb', 'wrgb']
+N_CHANNEL = 16
+
+
+def command_shape(pim_type_name, dhead, l, dbyte):
+    # per channel: (k strides, score rows, WRGB, score MVSB, context MVSB, MVGB)
+    n_mac = 32 // dbyte
+    if pim_type_name == PIMType.BUFFER.name:
+        # (pCH) R C
+        n_k = math.ceil(dhead / n_mac)
+        return (n_k, math.ceil(l / 2), n_k, 1, 1, math.ceil(l / (2 * n_mac)))
+    # (pCH) R, R, C (, C)
+    if pim_type_name == PIMType.BA.name:
+        n_k = math.ceil(dhead / 4 / n_mac)
+        wrgb, context_mvsb = 4 * n_k, 8
+    else:
+        n_k = math.ceil(dhead / n_mac)
+        wrgb, context_mvsb = n_k, 2
+    return (n_k, math.ceil(l / 16), wrgb, 8, context_mvsb,
+            8 * math.ceil(l / (16 * n_mac)))
+
+
+def count_commands(pim_type_name, dhead, nhead, l, dbyte):
+    # [mac, softmax, mvgb, mvsb, wrgb] of the trace, no trace is generated
+    n_k, n_score, wrgb, score_mvsb, context_mvsb, mvgb = command_shape(
+        pim_type_name, dhead, l, dbyte)
+    # strides of the score phase, MVGB is spread over half of a phase
+    score_len = math.ceil(n_score / 16)
+    score_half = math.ceil(score_len / 2)
+    context_half = math.ceil(n_k / 2)
+
+    # heads are mapped on 16 channels, the last iteration may use fewer
+    num_itr = math.ceil(nhead / N_CHANNEL)
+    channels = [N_CHANNEL] * (num_itr - 1) + [nhead % N_CHANNEL or N_CHANNEL]
+    counts = [0] * len(COUNT_COLUMNS)
+    for i in range(0, num_itr - 1, 2):
+        # overlapped head pair, the context phase of head 1 repeats head 0
+        c0, c1 = channels[i], channels[i + 1]
+        dummy_mac = c0 if i == 0 else 0
+        counts[0] += dummy_mac + n_score * n_k * (3 * c0 + c1)
+        counts[1] += c0 + c1
+        counts[2] += int(mvgb * c0 / score_half) * score_half + int(
+            mvgb * c1 / context_half) * context_half
+        counts[3] += score_len * score_mvsb * (c0 + c1) + \
+            2 * n_k * context_mvsb * c0
+        counts[4] += wrgb * c0 + int(wrgb * c1 / score_len) * score_len
+    if num_itr % 2 != 0:
+        c = channels[-1]
+        counts[0] += 2 * n_score * n_k * c
+        counts[1] += c
+        counts[2] += mvgb * c
+        counts[3] += score_len * score_mvsb * c + n_k * context_mvsb * c
+        counts[4] += wrgb * c
+    return counts
+
+
+def canonical_l(pim_type_name, l):
+    # The generators use L only through ceil(L / units) for the units of
+    # parallel score rows, so every L of a class has the same trace. The
+    # largest L of the class represents it.
+    units = 2 if pim_type_name == PIMType.BUFFER.name else 16
+    return units * math.ceil(l / units)
+
+
+def canonical_key(key):
+    return make_key(canonical_l(key[4], key[0]), *key[1:])
+
+
+def stale_tail_counts(pim_type_name, dhead, nhead, l, dbyte):
+    # Counts of the earlier generators, which issued the SFM and MVGB commands
+    # of an unpaired last head in every score stride as well. Results cached
+    # with them are kept, but they differ from count_commands().
+    counts = count_commands(pim_type_name, dhead, nhead, l, dbyte)
+    if math.ceil(nhead / N_CHANNEL) % 2 != 0:
+        _, n_score, _, _, _, mvgb = command_shape(pim_type_name, dhead, l,
+                                                  dbyte)
+        c = nhead % N_CHANNEL or N_CHANNEL
+        counts[1] += math.ceil(n_score / 16) * c
+        counts[2] += math.ceil(n_score / 16) * mvgb * c
+    return counts
+
+
+def check_log_counts(output_log):
+    # compare the cached command counts with the closed form,
+    # returns (rows, stale rows, mismatched rows)
+    df = read_log(output_log)
+    num_stale = 0
+    mismatches = []
+    for row in df.itertuples(index=False):
+        key = (row.pim_type, row.dhead, row.nhead, row.L, row.dbyte)
+        logged = [getattr(row, c) for c in COUNT_COLUMNS]
+        if logged == count_commands(*key):
+            continue
+        if logged == stale_tail_counts(*key):
+            num_stale += 1
+        else:
+            mismatches.append(row)
+    return len(df), num_stale, mismatches
+
+
+_trace_generators = {}
+
+
+def load_trace_generator(path):
+    # import a trace_gen/gen_trace_attacc_*.py script once per process
+    path = os.path.abspath(path)
+    if path not in _trace_generators:
+        name = os.path.splitext(os.path.basename(path))[0]
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _trace_generators[path] = module
+    return _trace_generators[path]
+
+
+def make_key(l, nhead, dhead, dbyte, pim_type_name, power_constraint):
+    return (int(l), int(nhead), int(dhead), int(dbyte), str(pim_type_name),
+            bool(power_constraint))
+
+
+def pack_key(key):
+    l, nhead, dhead, dbyte, pim_type_name, power_constraint = key
+    fields = [
+        l, nhead, dhead, dbyte, PIMType[pim_type_name].value,
+        int(power_constraint)
+    ]
+    packed = 0
+    for field, bits in zip(fields, KEY_BITS):
+        if field < 0 or field >= (1 << bits):
+            return None
+        packed = (packed << bits) | field
+    return packed
+
+
+def read_log(path):
+    # log (or stats) CSV, rows of the earlier format get an empty provenance
+    df = pd.read_csv(path, dtype={'provenance': str})
+    if 'provenance' not in df.columns:
+        df['provenance'] = ''
+    df['provenance'] = df['provenance'].fillna('')
+    return df
+
+
+def provenance_id(provenance):
+    # int64 of a provenance in the snapshot, 0 if unknown
+    return int(provenance[:15], 16) if provenance else 0
+
+
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def snapshot_path(output_log):
+    return output_log + '.npy'
+
+
+def stats_path(output_log):
+    return output_log + '.stats'
+
+
+def lock_path(output_log):
+    return output_log + '.lock'
+
+
+def claim_path(output_log, key):
+    # lock file held by the process that simulates a key
+    return os.path.join(output_log + '.claims',
+                        '_'.join(str(i) for i in key) + '.lock')
+
+
+@contextmanager
+def file_lock(path):
+    # exclusive advisory lock shared by all processes using the same path
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _tail_crc(data, nbytes):
+    return zlib.crc32(data[max(nbytes - CRC_BYTES, 0):nbytes])
+
+
+def read_log_rows(data):
+    # parse appended CSV rows (no header), [(key, values, provenance)]
+    rows = []
+    num_keys = len(KEY_COLUMNS)
+    for row in csv.reader(io.StringIO(data.decode())):
+        if len(row) not in [len(LOG_COLUMNS), len(LOG_COLUMNS) - 1
+                           ] or row[0] == LOG_COLUMNS[0]:
+            continue
+        key = make_key(row[0], row[1], row[2], row[3], row[4],
+                       row[5] == 'True')
+        values = [int(i) for i in row[num_keys:num_keys + NUM_VALUES]]
+        rows.append((key, values, ''.join(row[num_keys + NUM_VALUES:])))
+    return rows
+
+
+def write_snapshot(output_log):
+    with file_lock(lock_path(output_log)):
+        return _write_snapshot(output_log)
+
+
+def snapshot_rows(df):
+    # (packed keys, values and provenance ids, rows of df not packed): the
+    # rows that Ramulator.index_row() may select, the first row of each key
+    # and provenance, sorted by key and in log order within a key
+    df = df.drop_duplicates(subset=KEY_COLUMNS + ['provenance'], keep='first')
+    fields = [df[c].to_numpy(dtype=np.int64) for c in KEY_COLUMNS[:4]] + [
+        df['pim_type'].map({t.name: t.value for t in PIMType}).fillna(-1)
+        .to_numpy(dtype=np.int64),
+        df['power_constraint'].to_numpy(dtype=np.int64)
+    ]
+    packed = np.zeros(len(df), dtype=np.int64)
+    packable = np.ones(len(df), dtype=bool)
+    for field, bits in zip(fields, KEY_BITS):
+        packable &= (field >= 0) & (field < (1 << bits))
+        packed = (packed << bits) | (field & ((1 << bits) - 1))
+    provenances = df['provenance'].to_numpy()
+    ids = {provenance: provenance_id(provenance)
+           for provenance in set(provenances.tolist())}
+    table = np.vstack([
+        df[VALUE_COLUMNS].to_numpy(dtype=np.int64).T,
+        np.array([ids[p] for p in provenances], dtype=np.int64)
+    ]).reshape(NUM_VALUES + 1, len(df))
+    # stable, the rows of a key stay in log order
+    order = np.argsort(packed[packable], kind='stable')
+    return packed[packable][order], table[:, packable][:, order], df[
+        ~packable]
+
+
+def _write_snapshot(output_log):
+    # build the snapshot of the log, see snapshot_rows()
+    with open(output_log, 'rb') as f:
+        data = f.read()
+    nbytes = data.rfind(b'\n') + 1
+    keys, table, rest = snapshot_rows(read_log(io.BytesIO(data[:nbytes])))
+    if len(rest) > 0:
+        # not representable, the whole log is left to the CSV tail
+        nbytes = 0
+        keys, table = keys[:0], table[:, :0]
+
+    header = np.array(
+        [SNAPSHOT_VERSION, nbytes,
+         _tail_crc(data, nbytes),
+         len(keys)],
+        dtype=np.int64)
+    snapshot = np.concatenate([header, keys, table.reshape(-1)])
+
+    path = snapshot_path(output_log)
+    tmp_path = path + '.tmp.npy'
+    np.save(tmp_path, snapshot)
+    os.replace(tmp_path, path)
+    return len(keys)
+
+
+def load_snapshot(output_log):
+    # memory-mapped (keys, values, provenance ids, csv bytes),
+    # None if missing or stale
+    path = snapshot_path(output_log)
+    if not os.path.exists(path) or not os.path.exists(output_log):
+        return None
+    try:
+        snapshot = np.load(path, mmap_mode='r')
+    except (ValueError, OSError):
+        return None
+    if len(snapshot) < SNAPSHOT_HEADER or snapshot[0] != SNAPSHOT_VERSION:
+        return None
+    version, nbytes, crc, n = [int(i) for i in snapshot[:SNAPSHOT_HEADER]]
+    if os.path.getsize(output_log) < nbytes:
+        return None
+    with open(output_log, 'rb') as f:
+        f.seek(max(nbytes - CRC_BYTES, 0))
+        if zlib.crc32(f.read(min(nbytes, CRC_BYTES))) != crc:
+            return None
+    keys = snapshot[SNAPSHOT_HEADER:SNAPSHOT_HEADER + n]
+    values = snapshot[SNAPSHOT_HEADER + n:].reshape(NUM_VALUES + 1, n)
+    return keys, values[:NUM_VALUES], values[NUM_VALUES], nbytes
+
+
+async def drain_pipe(path, writer):
+    # Unblock a trace writer whose reader exited early. Ramulator reads the
+    # whole trace before simulating, so this only reads data after a failure.
+    fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        while not writer.done():
+            try:
+                data = os.read(fd, 1 << 16)
+            except BlockingIOError:
+                data = b''
+            if not data:
+                # empty, or no writer yet (the worker may not have started)
+                await asyncio.sleep(0.01)
+    finally:
+        os.close(fd)
+
+
+## Ramulator prints its stats as "name: value" lines
+STAT_LINE = re.compile(r'^\s*(\w+):\s*(-?\d+)\s*$')
+## request names of the stats, in the order of COUNT_COLUMNS
+STAT_REQUESTS = [['mac_all_bank', 'mac_same_bank', 'mac_per_bank'],
+                 ['softmax'], ['move_to_gemv_buffer'],
+                 ['move_to_softmax_buffer'], ['write_to_gemv_buffer']]
+## Channel stats, stored next to the log (<log>.stats): cycles by PIM command
+## type (summed over channels), busy and barrier stall cycles per channel
+CYCLE_COLUMNS = ['{}_cycles'.format(c) for c in COUNT_COLUMNS]
+STATS_VALUE_COLUMNS = CYCLE_COLUMNS + [
+    'busy_{}'.format(i) for i in range(N_CHANNEL)
+] + ['barrier_stall_{}'.format(i) for i in range(N_CHANNEL)]
+STATS_COLUMNS = KEY_COLUMNS + STATS_VALUE_COLUMNS + ['provenance']
+PHASES = ['score', 'softmax', 'context']
+
+
+def parse_stats(output):
+    # {stat name: value} of the Ramulator output, other lines are skipped
+    stats = {}
+    for line in output.split('\n'):
+        match = STAT_LINE.match(line)
+        if match is not None:
+            stats[match.group(1)] = int(match.group(2))
+    return stats
+
+
+def log_values(stats):
+    # [cycle, mac, softmax, mvgb, mvsb, wrgb] of the log
+    counts = [
+        sum(stats.get('total_num_pim_{}_requests'.format(r), 0)
+            for r in requests) for requests in STAT_REQUESTS
+    ]
+    return [stats.get('memory_system_cycles', 0)] + counts
+
+
+def channel_values(stats):
+    # STATS_VALUE_COLUMNS of the stats, None if Ramulator does not report them
+    # (built before the channel stats were added)
+    if 'busy_cycles_0' not in stats:
+        return None
+    cycles = [
+        sum(
+            stats.get('pim_{}_cycles_{}'.format(r, i), 0)
+            for r in requests
+            for i in range(N_CHANNEL)) for requests in STAT_REQUESTS
+    ]
+    busy = [stats.get('busy_cycles_{}'.format(i), 0) for i in range(N_CHANNEL)]
+    stall = [
+        stats.get('barrier_stall_cycles_{}'.format(i), 0)
+        for i in range(N_CHANNEL)
+    ]
+    return cycles + busy + stall
+
+
+def phase_commands(pim_type_name, dhead, nhead, l, dbyte):
+    # [mac, mvsb] of the score and of the context phase, they add up to the
+    # mac and mvsb of count_commands()
+    n_k, n_score, _, score_mvsb, context_mvsb, _ = command_shape(
+        pim_type_name, dhead, l, dbyte)
+    score_len = math.ceil(n_score / 16)
+    num_itr = math.ceil(nhead / N_CHANNEL)
+    channels = [N_CHANNEL] * (num_itr - 1) + [nhead % N_CHANNEL or N_CHANNEL]
+    score, context = [0, 0], [0, 0]
+    for i in range(0, num_itr - 1, 2):
+        # the context phase of head 1 repeats head 0
+        c0, c1 = channels[i], channels[i + 1]
+        score[0] += (c0 if i == 0 else 0) + n_score * n_k * (c0 + c1)
+        score[1] += score_len * score_mvsb * (c0 + c1)
+        context[0] += 2 * n_score * n_k * c0
+        context[1] += 2 * n_k * context_mvsb * c0
+    if num_itr % 2 != 0:
+        c = channels[-1]
+        score[0] += n_score * n_k * c
+        score[1] += score_len * score_mvsb * c
+        context[0] += n_score * n_k * c
+        context[1] += n_k * context_mvsb * c
+    return score, context
+
+
+def phase_fractions(pim_type_name, dhead, nhead, l, dbyte, stats):
+    # shares of the score, softmax and context phases in the channel cycles.
+    # WRGB belongs to the score, SFM and MVGB to the softmax, MAC and MVSB
+    # cycles are split by the commands of each phase.
+    mac, softmax, mvgb, mvsb, wrgb = stats[:len(COUNT_COLUMNS)]
+    score, context = phase_commands(pim_type_name, dhead, nhead, l, dbyte)
+    mac_score = score[0] / max(score[0] + context[0], 1)
+    mvsb_score = score[1] / max(score[1] + context[1], 1)
+    phases = [
+        wrgb + mac * mac_score + mvsb * mvsb_score, softmax + mvgb,
+        mac * (1 - mac_score) + mvsb * (1 - mvsb_score)
+    ]
+    total = sum(phases)
+    if total == 0:
+        return None
+    return [i / total for i in phases]
+
+
+class JobScheduler:
+    # Runs Ramulator jobs on an asyncio event loop. At most num_workers
+    # Ramulator processes run at once and a job that times out or fails is
+    # retried. Traces are generated in worker processes: a pipe is written
+    # while Ramulator reads it, and file traces of the next jobs are generated
+    # while Ramulator runs.
+
+    def __init__(self, ramulator):
+        self.ramulator = ramulator
+
+    def run(self, jobs):
+        # {key: job} -> {key: result}, results are logged as they finish
+        return asyncio.run(self.run_all(jobs))
+
+    async def run_all(self, jobs):
+        num_workers = max(min(self.ramulator.num_workers, len(jobs)), 1)
+        self.run_slots = asyncio.Semaphore(num_workers)
+        self.trace_slots = asyncio.Semaphore(num_workers)
+        with concurrent.futures.ProcessPoolExecutor(num_workers) as pool:
+            self.pool = pool
+            results = await asyncio.gather(
+                *[self.run_job(key, job) for key, job in jobs.items()],
+                return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return dict(zip(jobs.keys(), results))
+
+    async def run_job(self, key, job):
+        ramulator = self.ramulator
+        claim = await self.claim(key)
+        if claim is None:
+            # logged by another process
+            return ramulator.lookup(key)
+        try:
+            return await self.simulate(key, job, claim)
+        finally:
+            fcntl.flock(claim, fcntl.LOCK_UN)
+            claim.close()
+
+    async def claim(self, key):
+        # Claim a key across processes: the open claim file, locked, or None
+        # if the result is logged. A key claimed by another process is waited
+        # for, then checked again in case that process failed.
+        ramulator = self.ramulator
+        path = claim_path(ramulator.output_log, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        while True:
+            with file_lock(lock_path(ramulator.output_log)):
+                ramulator.refresh()
+                if ramulator.lookup(key) is not None:
+                    return None
+                claim = open(path, 'a')
+                try:
+                    fcntl.flock(claim, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return claim
+                except BlockingIOError:
+                    pass
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, fcntl.flock, claim, fcntl.LOCK_EX)
+                fcntl.flock(claim, fcntl.LOCK_UN)
+            finally:
+                claim.close()
+
+    async def simulate(self, key, job, claim):
+        ramulator = self.ramulator
+        pim_type, l, num_ops_per_hbm, dbyte, power_constraint = job
+        for attempt in range(ramulator.retries + 1):
+            try:
+                stats = await self.attempt(job)
+            except RuntimeError as e:
+                error = e
+                continue
+            # Ramulator must issue every command of the trace
+            result = log_values(stats)
+            counts = count_commands(pim_type.name, ramulator.dhead,
+                                    num_ops_per_hbm, l, dbyte)
+            if result[1:] == counts:
+                provenance = ramulator.provenance(pim_type.name,
+                                                  power_constraint) or ''
+                values = channel_values(stats)
+                if values is not None:
+                    ramulator.update_stats_file(
+                        list(key) + values + [provenance])
+                ramulator.update_log_file(list(key) + result + [provenance])
+                # processes waiting for the claim find the result in the log,
+                # later ones do not open the claim file
+                os.unlink(claim.name)
+                return result
+            error = RuntimeError(
+                "Ramulator issued {} commands, the trace has {}".format(
+                    result[1:], counts))
+        raise RuntimeError("Ramulator failed {} times on {}: {}".format(
+            ramulator.retries + 1, key, error))
+
+    async def attempt(self, job):
+        ramulator = self.ramulator
+        pim_type, l, num_ops_per_hbm, dbyte, power_constraint = job
+        file_name = "attacc_l{}_nattn{}_dhead{}_dbyte{}_pc{}".format(
+            l, num_ops_per_hbm, ramulator.dhead, dbyte, int(power_constraint))
+        loop = asyncio.get_running_loop()
+
+        # every job has its own directory, removed even if the job fails
+        with tempfile.TemporaryDirectory(prefix=file_name + '_') as job_dir:
+            yaml_file = os.path.join(job_dir, file_name + '.yaml')
+            trace_file = os.path.join(job_dir, file_name + '.trace')
+            ramulator.make_yaml_file(yaml_file, trace_file, power_constraint)
+            trace_args = (pim_type, l, num_ops_per_hbm, dbyte, trace_file)
+
+            if ramulator.trace_mode == 'pipe':
+                # Ramulator reads the trace while it is generated
+                os.mkfifo(trace_file)
+                async with self.run_slots:
+                    writer = loop.run_in_executor(self.pool,
+                                                  ramulator.stream_trace,
+                                                  *trace_args)
+                    return await self.run_ramulator(yaml_file, trace_file,
+                                                    writer)
+
+            # stored traces are files, shared with the other power constraint
+            generate = ramulator.generate_trace
+            if ramulator.trace_store is not None:
+                generate = ramulator.store_trace
+            async with self.trace_slots:
+                try:
+                    await loop.run_in_executor(self.pool, generate,
+                                               *trace_args)
+                except Exception as e:
+                    raise RuntimeError(
+                        "Trace generation failed for {}: {!r}".format(
+                            trace_file, e)) from e
+                await self.run_slots.acquire()
+            try:
+                return await self.run_ramulator(yaml_file, trace_file)
+            finally:
+                self.run_slots.release()
+
+    async def run_ramulator(self, yaml_file, trace_file, writer=None):
+        # run ramulator in the job directory, side outputs stay there
+        ramulator_dir = os.path.abspath(self.ramulator.ramulator_dir)
+        ramulator_file = os.path.join(ramulator_dir, "ramulator2")
+        timeout = self.ramulator.timeout
+        proc = None
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                ramulator_file,
+                "-f",
+                yaml_file,
+                stdout=asyncio.subprocess.PIPE,
+                cwd=os.path.dirname(yaml_file))
+            stdout, _ = await asyncio.wait_for(proc.communicate(), timeout)
+        except asyncio.TimeoutError:
+            raise RuntimeError("Ramulator timed out after {} s on {}".format(
+                timeout, yaml_file))
+        except OSError as e:
+            # e.g., a missing or non-executable binary, the pipe is drained
+            raise RuntimeError("Cannot run {} on {}: {!r}".format(
+                ramulator_file, yaml_file, e)) from e
+        finally:
+            if proc is not None and proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            if writer is not None:
+                await drain_pipe(trace_file, writer)
+
+        if proc.returncode != 0:
+            raise RuntimeError("Ramulator exited with code {} on {}".format(
+                proc.returncode, yaml_file))
+        if writer is not None and writer.exception() is not None:
+            raise RuntimeError("Trace generation failed for {}: {}".format(
+                trace_file, writer.exception()))
+        return parse_stats(stdout.decode())
+
+
+class TraceStore:
+    # Content-addressed trace files shared by all jobs and processes.
+    # A trace is named after the hash of the generator source and its inputs,
+    # and the least recently used traces are removed beyond max_bytes.
+
+    def __init__(self, directory, max_bytes=TRACE_STORE_SIZE * 2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.sources = {}
+
+    def digest(self, generator_path, *args):
+        if generator_path not in self.sources:
+            with open(generator_path, 'rb') as f:
+                self.sources[generator_path] = hashlib.sha256(
+                    f.read()).hexdigest()
+        key = "{} {}".format(self.sources[generator_path], repr(args))
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest + '.trace')
+
+    def fetch(self, digest, dest, generate):
+        # place the trace at dest, generate(path) writes it on a miss;
+        # returns True on a hit
+        path = self.path(digest)
+        with file_lock(path + '.lock'):
+            hit = self._link(path, dest)
+            if not hit:
+                # evict() may remove the lock file meanwhile, so two processes
+                # may generate the same trace, each into its own file
+                tmp = '{}.{}.tmp'.format(path, os.getpid())
+                generate(tmp)
+                self._link(tmp, dest)
+                os.replace(tmp, path)
+        self.evict()
+        return hit
+
+    def _link(self, path, dest):
+        # the job keeps its own link, so the trace may be evicted meanwhile
+        try:
+            os.link(path, dest)
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copyfile(path, dest)
+        os.utime(path)
+        return True
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.trace'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(entry[1] for entry in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for evicted in [name, name + '.lock']:
+                try:
+                    os.unlink(os.path.join(self.directory, evicted))
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+
+class CycleModel:
+    # Surrogate of the Ramulator cycles fitted from the cache. The trace of a
+    # head pair depends on L only through the score rows (ceil(L / units)),
+    # so per (pim_type, dbyte, power_constraint, dhead) the cycles are
+    # modeled as (head iterations) x h(score rows), with h piecewise linear
+    # between the sampled score rows. The error bound of a query is the
+    # largest relative error at the two enclosing knots, each predicted
+    # from the cache (in-sample) and from its neighbours (leave-one-out).
+
+    def __init__(self, df):
+        self.groups = {}
+        df = df.drop_duplicates(subset=KEY_COLUMNS, keep='first')
+        for group, rows in df.groupby(
+            ['pim_type', 'dbyte', 'power_constraint', 'dhead']):
+            pim_type_name, dbyte, power_constraint, dhead = group
+            n_score = np.array([
+                command_shape(pim_type_name, dhead, l, dbyte)[1]
+                for l in rows['L']
+            ])
+            num_itr = np.ceil(rows['nhead'].values / N_CHANNEL)
+            cycle = rows['cycle'].values.astype(np.float64)
+
+            # least squares of cycle = num_itr * h per sampled score rows
+            knots, inv = np.unique(n_score, return_inverse=True)
+            h = np.bincount(inv, cycle * num_itr) / np.bincount(
+                inv, num_itr * num_itr)
+            error = np.abs(h[inv] * num_itr - cycle) / cycle
+            if len(knots) > 2:
+                # interior knots interpolated from their neighbours
+                h_loo = h.copy()
+                h_loo[1:-1] = (h[:-2] * (knots[2:] - knots[1:-1]) + h[2:] *
+                               (knots[1:-1] - knots[:-2])) / (knots[2:] -
+                                                              knots[:-2])
+                error = np.maximum(
+                    error, np.abs(h_loo[inv] * num_itr - cycle) / cycle)
+            knot_error = np.zeros(len(knots))
+            np.maximum.at(knot_error, inv, error)
+            # the head iterations not sampled at a knot add their own error
+            itr_error = {
+                int(i): float(error[num_itr == i].max())
+                for i in np.unique(num_itr)
+            }
+
+            key = (pim_type_name, int(dbyte), bool(power_constraint),
+                   int(dhead))
+            self.groups[key] = (knots, h, knot_error, itr_error)
+
+    def predict(self, pim_type_name, l, nhead, dhead, dbyte,
+                power_constraint):
+        # (cycle, relative error bound), None outside the fitted range
+        key = (pim_type_name, int(dbyte), bool(power_constraint), int(dhead))
+        if key not in self.groups:
+            return None
+        knots, h, knot_error, itr_error = self.groups[key]
+        n_score = command_shape(pim_type_name, dhead, l, dbyte)[1]
+        num_itr = math.ceil(nhead / N_CHANNEL)
+        if not (knots[0] <= n_score <= knots[-1] and
+                min(itr_error) <= num_itr <= max(itr_error)):
+            return None
+        idx = int(np.searchsorted(knots, n_score))
+        if knots[idx] == n_score:
+            error = knot_error[idx]
+        else:
+            error = max(knot_error[idx - 1], knot_error[idx])
+        error = max(error, itr_error.get(num_itr, max(itr_error.values())))
+        cycle = num_itr * np.interp(n_score, knots, h)
+        return int(round(cycle)), float(error)
+
 
 class Ramulator:
 
@@ -14,20 +786,294 @@ class Ramulator:
                  ramulator_dir,
                  output_log='',
                  fast_mode=False,
-                 num_hbm=5):
-        self.df = pd.DataFrame()
+                 group_size=64,
+                 num_hbm=5,
+                 num_workers=None,
+                 trace_mode='pipe',
+                 trace_store=None,
+                 trace_store_size=TRACE_STORE_SIZE,
+                 surrogate=False,
+                 surrogate_tolerance=0.1,
+                 timeout=None,
+                 retries=2):
+        assert trace_mode in TRACE_MODES, "Unknown trace mode {}".format(
+            trace_mode)
         self.ramulator_dir = ramulator_dir
         self.output_log = output_log
-        if os.path.exists(output_log):
-            self.df = pd.read_csv(output_log)
+        self.index = {}
+        self.snapshot = None
+        self.log_offset = 0
+        self.log_inode = None
+        self.loaded = False
         self.tCK = 0.769  # ns
         self.num_hbm = num_hbm
         self.nhead = modelinfos['num_heads']
         self.dhead = modelinfos['dhead']
+        # fast_mode simulates group_size heads per HBM (full head pairs)
+        # and scales the cycles to the number of heads
+        if group_size <= 0 or group_size % (2 * N_CHANNEL) != 0:
+            raise ValueError("group_size must be a positive multiple of {}, "
+                             "got {}".format(2 * N_CHANNEL, group_size))
         self.fast_mode = fast_mode
+        self.group_size = group_size
+        # number of Ramulator runs launched in parallel by prefetch()
+        self.num_workers = os.cpu_count() if num_workers is None else num_workers
+        # seconds a Ramulator run may take, and reruns of a failed job
+        self.timeout = timeout
+        self.retries = retries
+        self.trace_mode = trace_mode if trace_store is None else 'file'
+        # optional directory of generated traces (TraceStore)
+        self.trace_store = None if trace_store is None else TraceStore(
+            trace_store, int(trace_store_size * 2**30))
+        # answer missing shapes with a CycleModel of the cache if its error
+        # bound is within surrogate_tolerance, otherwise run Ramulator
+        self.surrogate = surrogate
+        self.surrogate_tolerance = surrogate_tolerance
+        self.cycle_model = None
+        self.cycle_model_offset = None
+        self.num_estimates = 0
+        self.estimate_error = 0.0
+        # channel stats of the results (<log>.stats), read when it grows
+        self.stats_index = {}
+        self.stats_size = 0
+        # provenance of (pim_type, power_constraint), keys of index entries
+        # with an unknown provenance
+        self.provenances = {}
+        self.legacy_keys = set()
 
-    def make_yaml_file(self, yaml_file, file_name, power_constraint):
-        trace_path = os.path.join(self.ramulator_dir, file_name + ".trace")
+    def __getstate__(self):
+        # prefetch() workers only run Ramulator, the cache stays in the parent
+        state = self.__dict__.copy()
+        state.update(index={},
+                     legacy_keys=set(),
+                     snapshot=None,
+                     cycle_model=None,
+                     cycle_model_offset=None,
+                     stats_index={},
+                     stats_size=0,
+                     log_offset=0,
+                     log_inode=None,
+                     loaded=False)
+        return state
+
+    def load(self):
+        # the cache is loaded on the first lookup
+        if self.loaded:
+            return
+        self.loaded = True
+        self.index = {}
+        self.legacy_keys = set()
+        self.snapshot = None
+        self.log_offset = 0
+        self.log_inode = None
+        if not os.path.exists(self.output_log):
+            return
+        self.snapshot = load_snapshot(self.output_log)
+        if self.snapshot is not None:
+            self.log_offset = self.snapshot[3]
+        self.refresh()
+
+    def refresh(self):
+        # read the rows appended to the log by this or other processes
+        self.load()
+        if not os.path.exists(self.output_log):
+            return
+        with open(self.output_log, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if self.log_inode is not None and (
+                    stat.st_ino != self.log_inode or
+                    stat.st_size < self.log_offset):
+                # the log was rewritten (e.g., compacted)
+                self.loaded = False
+                self.load()
+                return
+            f.seek(self.log_offset)
+            data = f.read()
+        self.log_inode = stat.st_ino
+
+        # an incomplete last line is read on the next refresh
+        nbytes = data.rfind(b'\n') + 1
+        if nbytes == 0:
+            return
+        if self.log_offset == 0:
+            self.build_index(read_log(io.BytesIO(data[:nbytes])))
+        else:
+            for key, value, provenance in read_log_rows(data[:nbytes]):
+                self.index_row(key, value, provenance)
+        self.log_offset += nbytes
+
+    def build_index(self, df):
+        # Index of the whole log without a snapshot file: the rows are packed
+        # from whole columns into an in-memory snapshot, searched like the
+        # file. The rows of keys that cannot be packed are indexed one by one.
+        if not self.index and (self.snapshot is None or
+                               len(self.snapshot[0]) == 0):
+            keys, table, df = snapshot_rows(df)
+            self.snapshot = (keys, table[:NUM_VALUES], table[NUM_VALUES], 0)
+        for row in df.itertuples(index=False):
+            key = make_key(row.L, row.nhead, row.dhead, row.dbyte,
+                           row.pim_type, row.power_constraint)
+            self.index_row(key, [int(getattr(row, c)) for c in VALUE_COLUMNS],
+                           row.provenance)
+
+    def index_row(self, key, value, provenance):
+        # the first accepted row of a key wins, a row of the current build
+        # replaces a row with an unknown provenance
+        if not self.accepts(key, provenance_id(provenance)):
+            return
+        if key not in self.index and self.snapshot is not None:
+            # the rows of the snapshot precede the rows of the CSV tail
+            row = self.snapshot_row(key)
+            if row is not None:
+                self.index[key] = row[0]
+                if row[1] == 0:
+                    self.legacy_keys.add(key)
+        if key in self.index and (key not in self.legacy_keys or
+                                  not provenance):
+            return
+        self.index[key] = value
+        if provenance:
+            self.legacy_keys.discard(key)
+        else:
+            self.legacy_keys.add(key)
+
+    def lookup(self, key):
+        self.load()
+        if key in self.index:
+            return self.index[key]
+        if self.snapshot is not None:
+            row = self.snapshot_row(key)
+            if row is not None:
+                # kept as index_row() would, a later row of the current build
+                # still replaces a row with an unknown provenance
+                self.index[key] = row[0]
+                if row[1] == 0:
+                    self.legacy_keys.add(key)
+                return row[0]
+        return None
+
+    def snapshot_row(self, key):
+        # (values, provenance id) of the row of a key in the snapshot, selected
+        # as by index_row(), None if no row of the key is accepted
+        keys, values, provenances, _ = self.snapshot
+        packed = pack_key(key)
+        if packed is None:
+            return None
+        legacy = None
+        for idx in range(int(np.searchsorted(keys, packed, 'left')),
+                         int(np.searchsorted(keys, packed, 'right'))):
+            provenance_id_ = int(provenances[idx])
+            if provenance_id_ == 0:
+                if legacy is None:
+                    legacy = idx
+            elif self.accepts(key, provenance_id_):
+                return [int(i) for i in values[:, idx]], provenance_id_
+        if legacy is None:
+            return None
+        return [int(i) for i in values[:, legacy]], 0
+
+    def provenance(self, pim_type_name, power_constraint):
+        # fingerprint of the Ramulator binary, its configuration and the
+        # traces of the PIM type, None if Ramulator is not installed
+        key = (pim_type_name, bool(power_constraint))
+        if key not in self.provenances:
+            self.provenances[key] = None
+            ramulator_file = os.path.join(self.ramulator_dir, "ramulator2")
+            if os.path.exists(ramulator_file):
+                h = hashlib.sha1()
+                h.update(file_digest(ramulator_file).encode())
+                h.update(self.yaml_config('', power_constraint).encode())
+                h.update(self.trace_digest(pim_type_name).encode())
+                self.provenances[key] = h.hexdigest()[:16]
+        return self.provenances[key]
+
+    def trace_digest(self, pim_type_name):
+        # traces of a reference shape, so that a change of the generator only
+        # changes the provenance of the PIM types whose traces differ
+        dhead, num_ops_per_hbm, l = PROVENANCE_SHAPE
+        trace_exc, args = self.trace_generator(PIMType[pim_type_name], l,
+                                               num_ops_per_hbm, 2)
+        generator = load_trace_generator(trace_exc)
+        h = hashlib.sha1()
+        with tempfile.TemporaryDirectory() as trace_dir:
+            trace_file = os.path.join(trace_dir, 'provenance.trace')
+            for dbyte in [1, 2]:
+                generator.run_attention(args[0], dhead, num_ops_per_hbm, l,
+                                        trace_file, dbyte)
+                h.update(file_digest(trace_file).encode())
+        return h.hexdigest()
+
+    def accepts(self, key, provenance_id_):
+        # rows of another build are ignored, rows with an unknown provenance
+        # are accepted, all rows are if Ramulator is not installed
+        if provenance_id_ == 0:
+            return True
+        provenance = self.provenance(key[4], key[5])
+        return provenance is None or provenance_id(provenance) == provenance_id_
+
+    def lookup_class(self, key):
+        # the requested L first, then the representative of its class
+        result = self.lookup(key)
+        if result is None and canonical_key(key) != key:
+            result = self.lookup(canonical_key(key))
+        return result
+
+    def is_empty(self):
+        self.load()
+        return not self.index and (self.snapshot is None or
+                                   len(self.snapshot[0]) == 0)
+
+    def provenance_report(self):
+        # [(pim_type, power_constraint, provenance of this build, its rows,
+        #   rows with an unknown provenance, rows of other builds)]
+        df = read_log(self.output_log)
+        report = []
+        for (pim_type, power_constraint), group in df.groupby(
+            ['pim_type', 'power_constraint']):
+            provenance = self.provenance(pim_type, power_constraint)
+            unknown = int((group['provenance'] == '').sum())
+            current = int((group['provenance'] == provenance).sum())
+            report.append((pim_type, bool(power_constraint), provenance,
+                           current, unknown, len(group) - current - unknown))
+        return report
+
+    def accepted_rows(self, df):
+        # rows of a log (or stats) DataFrame that lookups accept
+        mask = [
+            self.accepts((None, None, None, None, pim_type, power_constraint),
+                         provenance_id(provenance))
+            for pim_type, power_constraint, provenance in zip(
+                df['pim_type'], df['power_constraint'], df['provenance'])
+        ]
+        return df[np.array(mask, dtype=bool)]
+
+    def estimate(self, pim_type: PIMType, l, num_ops_per_hbm, dbyte,
+                 power_constraint):
+        # (cycle, error bound) of the surrogate, None if it does not apply
+        self.refresh()
+        if self.cycle_model_offset != self.log_offset:
+            # fitted again when rows were added to the cache
+            self.cycle_model = None
+            if self.log_offset > 0:
+                with open(self.output_log, 'rb') as f:
+                    data = f.read(self.log_offset)
+                self.cycle_model = CycleModel(
+                    self.accepted_rows(read_log(io.BytesIO(data))))
+            self.cycle_model_offset = self.log_offset
+        if self.cycle_model is None:
+            return None
+        estimate = self.cycle_model.predict(pim_type.name, l, num_ops_per_hbm,
+                                            self.dhead, dbyte,
+                                            power_constraint)
+        if estimate is None or estimate[1] > self.surrogate_tolerance:
+            return None
+        return estimate
+
+    def make_yaml_file(self, yaml_file, trace_path, power_constraint):
+        with open(yaml_file, 'w') as f:
+            f.write(self.yaml_config(trace_path, power_constraint))
+
+    def yaml_config(self, trace_path, power_constraint):
         line = ""
         line += "Frontend:\n"
         line += "  impl: PIMLoadStoreTrace\n"
@@ -64,206 +1110,449 @@ class Ramulator:
         line += "\n"
         line += "  AddrMapper:\n"
         line += "    impl: HBM3-PIM\n"
-        with open(yaml_file, 'w') as f:
-            f.write(line)
+        return line
 
     def update_log_file(self, log):
-        if self.df.empty:
-            if os.path.exists(self.output_log):
-                df = pd.read_csv(self.output_log)
+        # the log file is append-only and shared by concurrent processes,
+        # rows appended by others are read first to avoid duplicated keys
+        key = make_key(*log[:6])
+        with file_lock(lock_path(self.output_log)):
+            if not has_provenance(self.output_log):
+                _add_provenance_column(self.output_log)
+                if os.path.exists(snapshot_path(self.output_log)):
+                    _write_snapshot(self.output_log)
+            self.refresh()
+            if self.lookup(key) is not None:
+                return
+
+            line = io.StringIO()
+            wrt = csv.writer(line, lineterminator='\n')
+            if os.path.exists(self.output_log) and os.path.getsize(
+                    self.output_log) > 0:
+                with open(self.output_log, 'rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        line.write('\n')
             else:
-                columns = [
-                    'L', 'nhead', 'dhead', 'dbyte', 'pim_type',
-                    'power_constraint', 'cycle', 'mac', 'softmax', 'mvgb',
-                    'mvsb', 'wrgb'
-                ]
-                df = pd.DataFrame(columns=columns)
-        else:
-            df = self.df
-        if len(df.columns) > 12:
-            import pdb
-            pdb.set_trace()
-        new_df = pd.DataFrame(columns=df.columns)
-        new_df.loc[0] = log
-        df = pd.concat([df, new_df]).drop_duplicates()
-        self.df = df
-        self.df.to_csv(self.output_log, index=False)
-
-    #def run_ramulator(self):
-    def run_ramulator(self, pim_type: PIMType, l, num_ops_per_hbm, dbyte,
-                      yaml_file, file_name):
+                wrt.writerow(LOG_COLUMNS)
+            wrt.writerow(log)
+            with open(self.output_log, 'ab') as f:
+                f.write(line.getvalue().encode())
+            self.refresh()
+
+    def update_stats_file(self, stats):
+        # appended under the lock of the log, before the result is logged
+        path = stats_path(self.output_log)
+        with file_lock(lock_path(self.output_log)):
+            if not has_provenance(path):
+                _add_provenance_column(path)
+            line = io.StringIO()
+            wrt = csv.writer(line, lineterminator='\n')
+            if not os.path.exists(path) or os.path.getsize(path) == 0:
+                wrt.writerow(STATS_COLUMNS)
+            wrt.writerow(stats)
+            with open(path, 'ab') as f:
+                f.write(line.getvalue().encode())
+
+    def lookup_stats(self, key):
+        # channel stats of a result (requested L first), None if not recorded
+        path = stats_path(self.output_log)
+        if not os.path.exists(path):
+            return None
+        size = os.path.getsize(path)
+        if size != self.stats_size:
+            self.stats_index = {}
+            self.stats_size = size
+            df = self.accepted_rows(read_log(path))
+            for row in df.itertuples(index=False):
+                row_key = make_key(row.L, row.nhead, row.dhead, row.dbyte,
+                                   row.pim_type, row.power_constraint)
+                if row_key not in self.stats_index:
+                    self.stats_index[row_key] = [
+                        int(getattr(row, c)) for c in STATS_VALUE_COLUMNS
+                    ]
+        stats = self.stats_index.get(key)
+        if stats is None:
+            stats = self.stats_index.get(canonical_key(key))
+        return stats
+
+    def phase_split(self, pim_type: PIMType, layer: Layer,
+                    power_constraint=True):
+        # shares of the score, softmax and context phases in the time of
+        # output() for a score layer, None without channel stats
+        _, num_ops_simulated = self.get_num_ops(layer)
+        key = make_key(layer.n, num_ops_simulated, layer.k, layer.dbyte,
+                       pim_type.name, power_constraint)
+        stats = self.lookup_stats(key)
+        if stats is None:
+            return None
+        return phase_fractions(pim_type.name, layer.k, num_ops_simulated,
+                               canonical_l(pim_type.name, layer.n),
+                               layer.dbyte, stats)
+
+    def trace_generator(self, pim_type: PIMType, l, num_ops_per_hbm, dbyte):
+        # generator script and the arguments of its run_attention()
         pim_type_name = pim_type.name.lower(
         ) if not pim_type == PIMType.BA else "bank"
-        trace_file = os.path.join(self.ramulator_dir, file_name + '.trace')
+        trace_exc = os.path.join(os.path.abspath(self.ramulator_dir),
+                                 "trace_gen/gen_trace_attacc_vec.py")
+        return trace_exc, (pim_type_name, self.dhead, num_ops_per_hbm, l,
+                           dbyte)
 
-        trace_exc = os.path.join(
-            self.ramulator_dir,
-            "trace_gen/gen_trace_attacc_{}.py".format(pim_type_name))
-        trace_args = "--dhead {} --nhead {} --seqlen {} --dbyte {} --output {}".format(
-            self.dhead, num_ops_per_hbm, l, dbyte, trace_file)
+    def generate_trace(self, pim_type: PIMType, l, num_ops_per_hbm, dbyte,
+                       trace_file):
+        trace_exc, args = self.trace_generator(pim_type, l, num_ops_per_hbm,
+                                               dbyte)
 
-        gen_trace_cmd = f"python {trace_exc} {trace_args}"
+        # same output as gen_trace_attacc_{pim_type_name}.py
+        generator = load_trace_generator(trace_exc)
+        num_cmds = generator.run_attention(*args[:4], trace_file, *args[4:])
+        assert num_cmds > 0, "Empty trace for L {} nhead {}".format(
+            l, num_ops_per_hbm)
+        return num_cmds
 
-        # generate trace
-        try:
-            os.system(gen_trace_cmd)
-        except Exception as e:
-            print(f"Error: {e}")
+    def store_trace(self, pim_type: PIMType, l, num_ops_per_hbm, dbyte,
+                    trace_file):
+        # take the trace from the store, the power constraint does not matter
+        trace_exc, args = self.trace_generator(pim_type, l, num_ops_per_hbm,
+                                               dbyte)
+        digest = self.trace_store.digest(trace_exc, *args)
+        self.trace_store.fetch(
+            digest, trace_file, lambda path: self.generate_trace(
+                pim_type, l, num_ops_per_hbm, dbyte, path))
 
-        # run ramulator
-        ramulator_file = os.path.join(self.ramulator_dir, "ramulator2")
-        run_ramulator_cmd = f"{ramulator_file} -f {yaml_file}"
-        try:
-            result = subprocess.run(run_ramulator_cmd,
-                                    stdout=subprocess.PIPE,
-                                    text=True,
-                                    shell=True)
-            output_lines = result.stdout.strip().split('\n')
-            output_list = [line.strip() for line in output_lines]
-        except subprocess.CalledProcessError as e:
-            print(f"Error: {e}")
-            assert 0
-
-        # remove trace
-        rm_trace_cmd = f"rm {trace_file}"
+    def stream_trace(self, *trace_args):
         try:
-            os.system(rm_trace_cmd)
-        except Exception as e:
-            print(f"Error: {e}")
-
-        # parsing output
-        n_cmds = {"mac": 0, "sfm": 0, "mvgb": 0, "mvsb": 0, "wrgb": 0}
-        cycle = 0
-        for line in output_list:
-            if "mac" in line:
-                n_cmds["mac"] += int(line.split()[-1])
-            elif "softmax_requests" in line:
-                n_cmds["sfm"] += int(line.split()[-1])
-            elif "move_to_gemv_buffer" in line:
-                n_cmds["mvgb"] += int(line.split()[-1])
-            elif "move_to_softmax_buffer" in line:
-                n_cmds["mvsb"] += int(line.split()[-1])
-            elif "write_to_gemv_buffer" in line:
-                n_cmds["wrgb"] += int(line.split()[-1])
-            elif "memory_system_cycles" in line:
-                cycle += int(line.split()[-1])
-
-        out = [
-            cycle, n_cmds["mac"], n_cmds["sfm"], n_cmds["mvgb"], n_cmds["mvsb"],
-            n_cmds["wrgb"]
-        ]
-        return out
+            return self.generate_trace(*trace_args)
+        except BaseException:
+            # a reader waiting for the pipe gets an empty trace instead of
+            # blocking forever, run_ramulator reports the error
+            os.close(os.open(trace_args[-1], os.O_WRONLY))
+            raise
+
+    def get_num_ops(self, layer: Layer):
+        # (heads per HBM, heads simulated per HBM)
+        num_ops_per_attacc = layer.numOp
+        num_ops_per_hbm = math.ceil(num_ops_per_attacc / self.num_hbm)
+        if self.fast_mode and num_ops_per_hbm > self.group_size:
+            return num_ops_per_hbm, self.group_size
+        return num_ops_per_hbm, num_ops_per_hbm
+
+    def get_cycle_scale(self, num_ops_per_hbm, num_ops_simulated):
+        # fast_mode: the cycles grow with the head iterations on 16 channels
+        return math.ceil(num_ops_per_hbm / N_CHANNEL) / math.ceil(
+            num_ops_simulated / N_CHANNEL)
+
+    def simulate(self, pim_type: PIMType, l, num_ops_per_hbm, dbyte,
+                 power_constraint):
+        # run Ramulator for a shape and log the result
+        key = make_key(l, num_ops_per_hbm, self.dhead, dbyte, pim_type.name,
+                       power_constraint)
+        job = (pim_type, l, num_ops_per_hbm, dbyte, power_constraint)
+        return JobScheduler(self).run({key: job})[key]
+
+    def prefetch(self, pim_type: PIMType, layers, power_constraint=True):
+        # run the missing shapes of the given score layers in parallel
+        # one job per L class
+        jobs = {}
+        self.refresh()
+        for layer in layers:
+            _, num_ops_per_hbm = self.get_num_ops(layer)
+            key = make_key(layer.n, num_ops_per_hbm, self.dhead, layer.dbyte,
+                           pim_type.name, power_constraint)
+            if self.lookup_class(key) is not None:
+                continue
+            key = canonical_key(key)
+            if key not in jobs:
+                jobs[key] = (pim_type, key[0], num_ops_per_hbm, layer.dbyte,
+                             power_constraint)
+        if self.surrogate:
+            jobs = {k: v for k, v in jobs.items() if self.estimate(*v) is None}
+        if len(jobs) == 0:
+            return
+        assert os.path.exists(self.ramulator_dir), "Need to install ramulator"
+
+        JobScheduler(self).run(jobs)
 
     def run(self, pim_type: PIMType, layer: Layer, power_constraint=True):
         if os.path.exists(self.ramulator_dir):
-            l = layer.n
-            dhead = self.dhead
+            l = canonical_l(pim_type.name, layer.n)
             dbyte = layer.dbyte
-            num_ops_per_attacc = layer.numOp
-            num_ops_per_hbm = math.ceil(num_ops_per_attacc / self.num_hbm)
-            num_ops_group = 1
-            if self.fast_mode:
-                minimum_heads = 64
-                num_ops_group = math.ceil(num_ops_per_hbm / minimum_heads)
-                num_ops_per_hbm = minimum_heads
-
-            file_name = "attacc_l{}_nattn{}_dhead{}_dbyte{}_pc{}".format(
-                l, num_ops_per_hbm, dhead, layer.dbyte, int(power_constraint))
-            yaml_file = os.path.join(self.ramulator_dir, file_name + '.yaml')
-            self.make_yaml_file(yaml_file, file_name, power_constraint)
-
-            result = self.run_ramulator(pim_type, l, num_ops_per_hbm,
-                                        layer.dbyte, yaml_file, file_name)
-
-            # remove trace
-            rm_yaml_cmd = f"rm {yaml_file}"
-            try:
-                os.system(rm_yaml_cmd)
-            except Exception as e:
-                print(f"Error: {e}")
-
-            # post processing
-            # 32: read granularity
-            cycle, mac, sfm, mvgb, mvsb, wrgb = result
-            si_io = wrgb * 32  # 256 bit
-            tsv_io = (wrgb + mvsb + mvgb) * 32
-            giomux_io = (wrgb + mvsb + mvgb) * 32
-            bgmux_io = (wrgb + mvsb + mvgb) * 32
-            mem_acc = mac * 32
-            if pim_type == PIMType.BA:
-                # pCH * Rank * bank group * bank
-                mem_acc *= 2 * 2 * 4 * 4
-            elif pim_type == PIMType.BG:
-                # pCH * Rank * bank group
-                mem_acc *= 2 * 2 * 4
-            else:
-                mem_acc *= 1
-
-            ## update log file
-
-            log = [
-                l, num_ops_per_hbm, dhead, dbyte, pim_type.name,
-                power_constraint
-            ] + result
-            self.update_log_file(log)
+            _, num_ops_simulated = self.get_num_ops(layer)
 
-            ## si, tsv, giomux to bgmux, bgmux to column decoder, bank RD
-            traffic = [si_io, tsv_io, giomux_io, bgmux_io, mem_acc]
-            traffic = [i * self.num_hbm for i in traffic]
-            traffic = [i * num_ops_group for i in traffic]
-            exec_time = self.tCK * cycle / 1000 / 1000 / 1000  # ns -> s
-            return exec_time, traffic
+            result = self.simulate(pim_type, l, num_ops_simulated, dbyte,
+                                   power_constraint)
+            return self.post_process(pim_type, layer, result)
 
         else:
             assert 0, "Need to install ramulator"
 
     def output(self, pim_type: PIMType, layer: Layer, power_constraint=True):
-        if self.df.empty:
+        if self.is_empty():
             self.run(pim_type, layer, power_constraint)
 
-        num_ops_per_attacc = layer.numOp
-        num_ops_per_hbm = math.ceil(num_ops_per_attacc / self.num_hbm)
-        num_ops_group = 1
-        if self.fast_mode:
-            minimum_heads = 64
-            num_ops_group = math.ceil(num_ops_per_hbm / minimum_heads)
-            num_ops_per_hbm = minimum_heads
+        _, num_ops_simulated = self.get_num_ops(layer)
 
         l = layer.n
         dhead = layer.k
         dbyte = layer.dbyte
-        row = self.df[(self.df['L'] == l) & (self.df['nhead'] == num_ops_per_hbm) & \
-                      (self.df['dbyte'] == dbyte) & (self.df['dhead'] == dhead) & \
-                      (self.df['power_constraint'] == power_constraint) &  \
-                      (self.df['pim_type'] == pim_type.name)]
-        if row.empty:
+        key = make_key(l, num_ops_simulated, dhead, dbyte, pim_type.name,
+                       power_constraint)
+        result = self.lookup_class(key)
+        if result is None:
+            # the result may have been logged by another process
+            self.refresh()
+            result = self.lookup_class(key)
+        if result is None and self.surrogate:
+            estimate = self.estimate(pim_type, l, num_ops_simulated, dbyte,
+                                     power_constraint)
+            if estimate is not None:
+                cycle, error = estimate
+                self.num_estimates += 1
+                self.estimate_error = max(self.estimate_error, error)
+                result = [cycle] + count_commands(pim_type.name, dhead,
+                                                  num_ops_simulated, l, dbyte)
+        if result is None:
             return self.run(pim_type, layer, power_constraint)
 
         else:
-            cycle = int(row.iloc[0]['cycle'])
-            mac = int(row.iloc[0]['mac'])
-            softmax = int(row.iloc[0]['softmax'])
-            mvgb = int(row.iloc[0]['mvgb'])
-            mvsb = int(row.iloc[0]['mvsb'])
-            wrgb = int(row.iloc[0]['wrgb'])
-            si_io = wrgb * 32  # 256 bit
-            tsv_io = (wrgb + mvsb + mvgb) * 32
-            giomux_io = (wrgb + mvsb + mvgb) * 32
-            bgmux_io = (wrgb + mvsb + mvgb) * 32
-            mem_acc = mac * 32
-            if pim_type == PIMType.BA:
-                # pCH * Rank * bank group * bank
-                mem_acc *= 2 * 2 * 4 * 4
-            elif pim_type == PIMType.BG:
-                # pCH * Rank * bank group
-                mem_acc *= 2 * 2 * 4
-            else:
-                mem_acc *= 2
-
-            ## si, tsv, giomux to bgmux, bgmux to column decoder, bank RD
-            traffic = [si_io, tsv_io, giomux_io, bgmux_io, mem_acc]
-            traffic = [i * self.num_hbm for i in traffic]
-            traffic = [i * num_ops_group for i in traffic]
-            exec_time = self.tCK * cycle / 1000 / 1000 / 1000  # ns -> s
-            exec_time *= num_ops_group
-            return exec_time, traffic
+            return self.post_process(pim_type, layer, result)
+
+    def get_result(self, pim_type: PIMType, l, num_ops_per_hbm, dbyte,
+                   power_constraint):
+        # cached result of a shape, Ramulator runs if it is installed
+        key = make_key(l, num_ops_per_hbm, self.dhead, dbyte, pim_type.name,
+                       power_constraint)
+        result = self.lookup_class(key)
+        if result is None and os.path.exists(self.ramulator_dir):
+            l = canonical_l(pim_type.name, l)
+            result = self.simulate(pim_type, l, num_ops_per_hbm, dbyte,
+                                   power_constraint)
+        return result
+
+    def fast_mode_report(self,
+                         pim_type: PIMType,
+                         dbyte,
+                         power_constraint=True,
+                         shapes=REFERENCE_SHAPES):
+        # cycles of fast_mode against full simulation for (L, heads per HBM),
+        # [(L, heads per HBM, full cycles, fast_mode cycles, relative error)]
+        # shapes without results are skipped if Ramulator is not installed
+        report = []
+        for l, num_ops_per_hbm in shapes:
+            if num_ops_per_hbm <= self.group_size:
+                continue
+            full = self.get_result(pim_type, l, num_ops_per_hbm, dbyte,
+                                   power_constraint)
+            group = self.get_result(pim_type, l, self.group_size, dbyte,
+                                    power_constraint)
+            if full is None or group is None:
+                continue
+            cycle = group[0] * self.get_cycle_scale(num_ops_per_hbm,
+                                                    self.group_size)
+            report.append(
+                (l, num_ops_per_hbm, full[0], cycle, (cycle - full[0]) / full[0]))
+        return report
+
+    def post_process(self, pim_type: PIMType, layer: Layer, result):
+        # (execution time, traffic) of a layer from the simulated heads
+        num_ops_per_hbm, num_ops_simulated = self.get_num_ops(layer)
+        cycle, counts = result[0], result[1:]
+        if num_ops_simulated != num_ops_per_hbm:
+            # fast_mode: the cycles are scaled, the commands are counted
+            cycle *= self.get_cycle_scale(num_ops_per_hbm, num_ops_simulated)
+            counts = count_commands(pim_type.name, layer.k, num_ops_per_hbm,
+                                    layer.n, layer.dbyte)
+        traffic = self.get_traffic(pim_type, counts)
+        exec_time = self.tCK * cycle / 1000 / 1000 / 1000  # ns -> s
+        return exec_time, traffic
+
+    def get_traffic(self, pim_type: PIMType, counts):
+        # 32: read granularity
+        mac, softmax, mvgb, mvsb, wrgb = counts
+        si_io = wrgb * 32  # 256 bit
+        tsv_io = (wrgb + mvsb + mvgb) * 32
+        giomux_io = (wrgb + mvsb + mvgb) * 32
+        bgmux_io = (wrgb + mvsb + mvgb) * 32
+        mem_acc = mac * 32
+        if pim_type == PIMType.BA:
+            # pCH * Rank * bank group * bank
+            mem_acc *= 2 * 2 * 4 * 4
+        elif pim_type == PIMType.BG:
+            # pCH * Rank * bank group
+            mem_acc *= 2 * 2 * 4
+        else:
+            mem_acc *= 2
+
+        ## si, tsv, giomux to bgmux, bgmux to column decoder, bank RD
+        traffic = [si_io, tsv_io, giomux_io, bgmux_io, mem_acc]
+        traffic = [i * self.num_hbm for i in traffic]
+        return traffic
+
+    def traffic(self, pim_type: PIMType, layer: Layer):
+        # traffic of output() from the command counts, without Ramulator
+        num_ops_per_hbm, _ = self.get_num_ops(layer)
+        counts = count_commands(pim_type.name, layer.k, num_ops_per_hbm,
+                                layer.n, layer.dbyte)
+        return self.get_traffic(pim_type, counts)
+
+
+def has_provenance(path):
+    # False for a log (or stats) file of the earlier format
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return True
+    with open(path) as f:
+        return 'provenance' in f.readline().strip().split(',')
+
+
+def _add_provenance_column(path):
+    # rewrite a file of the earlier format, its rows get an unknown provenance
+    df = read_log(path)
+    tmp_path = path + '.tmp'
+    df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def compact_log_file(output_log):
+    # rewrite the log without duplicated rows, the first row of a key and
+    # provenance wins
+    subset = KEY_COLUMNS + ['provenance']
+    with file_lock(lock_path(output_log)):
+        df = read_log(output_log)
+        num_rows = len(df)
+        df = df.drop_duplicates(subset=subset, keep='first')
+        tmp_log = output_log + '.tmp'
+        df.to_csv(tmp_log, index=False)
+        os.replace(tmp_log, output_log)
+        path = stats_path(output_log)
+        if os.path.exists(path):
+            stats = read_log(path).drop_duplicates(subset=subset,
+                                                   keep='first')
+            stats.to_csv(path + '.tmp', index=False)
+            os.replace(path + '.tmp', path)
+        if os.path.exists(snapshot_path(output_log)):
+            _write_snapshot(output_log)
+    return num_rows, len(df)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Maintenance of the Ramulator result cache",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--log",
+                        type=str,
+                        default="ramulator.out",
+                        help="path of the Ramulator result cache")
+    parser.add_argument("--compact",
+                        action='store_true',
+                        help="drop duplicated entries and rewrite the cache")
+    parser.add_argument("--snapshot",
+                        action='store_true',
+                        help="write the binary snapshot (<log>.npy) of the cache")
+    parser.add_argument("--check-counts",
+                        action='store_true',
+                        help="check the cached command counts against the "
+                        "closed-form count of the trace generators")
+    parser.add_argument("--provenance",
+                        action='store_true',
+                        help="count the cached rows of the Ramulator build "
+                        "and trace generators in --ramulator")
+
+    ## fast_mode accuracy report
+    parser.add_argument("--fast-mode-report",
+                        action='store_true',
+                        help="compare the cycles of fast_mode with full "
+                        "simulation on reference shapes")
+    parser.add_argument("--ramulator",
+                        type=str,
+                        default="ramulator2",
+                        help="Ramulator directory, runs missing shapes if "
+                        "installed")
+    parser.add_argument("--pim",
+                        type=str,
+                        default='bank',
+                        choices=['bank', 'bg', 'buffer'],
+                        help="pim mode")
+    parser.add_argument("--dhead", type=int, default=128, help="dhead")
+    parser.add_argument("--dbyte", type=int, default=2, help="data size (B)")
+    parser.add_argument("--powerlimit",
+                        action='store_true',
+                        help="power constraint for PIM")
+    parser.add_argument("--group-size",
+                        type=int,
+                        default=64,
+                        help="heads per HBM simulated in fast_mode")
+    parser.add_argument("--shapes",
+                        type=str,
+                        default=None,
+                        help="L:heads per HBM pairs separated by commas, "
+                        "default: {}".format(",".join(
+                            "{}:{}".format(*shape)
+                            for shape in REFERENCE_SHAPES)))
+
+    args = parser.parse_args()
+    if args.group_size <= 0 or args.group_size % (2 * N_CHANNEL) != 0:
+        parser.error("--group-size must be a positive multiple of {}".format(
+            2 * N_CHANNEL))
+
+    if args.compact:
+        num_rows, num_compacted = compact_log_file(args.log)
+        print("{}: {} rows -> {} rows".format(args.log, num_rows,
+                                              num_compacted))
+    if args.snapshot:
+        num_rows = write_snapshot(args.log)
+        print("{}: {} rows".format(snapshot_path(args.log), num_rows))
+    if args.check_counts:
+        num_rows, num_stale, mismatches = check_log_counts(args.log)
+        for row in mismatches:
+            print("mismatch: {}".format(",".join(str(i) for i in row)))
+        print("{}: {} rows, {} from earlier generators, {} mismatches".format(
+            args.log, num_rows, num_stale, len(mismatches)))
+        if mismatches:
+            raise SystemExit(1)
+    if args.provenance:
+        ramulator = Ramulator({
+            'num_heads': 0,
+            'dhead': args.dhead
+        }, args.ramulator, args.log)
+        print("pim_type,power_constraint,provenance,current,unknown,other")
+        for row in ramulator.provenance_report():
+            print(",".join(str(i) for i in row))
+    if args.fast_mode_report:
+        pim_type = {
+            'bank': PIMType.BA,
+            'bg': PIMType.BG,
+            'buffer': PIMType.BUFFER
+        }[args.pim]
+        shapes = REFERENCE_SHAPES
+        if args.shapes is not None:
+            shapes = [
+                tuple(int(i) for i in shape.split(':'))
+                for shape in args.shapes.split(',')
+            ]
+        ramulator = Ramulator({
+            'num_heads': 0,
+            'dhead': args.dhead
+        },
+                              args.ramulator,
+                              args.log,
+                              fast_mode=True,
+                              group_size=args.group_size)
+        report = ramulator.fast_mode_report(pim_type, args.dbyte,
+                                            args.powerlimit, shapes)
+        print("L,nhead,cycle,fast_mode_cycle,error")
+        for l, nhead, cycle, fast_cycle, error in report:
+            print("{},{},{},{:.0f},{:.2%}".format(l, nhead, cycle, fast_cycle,
+                                                  error))
+        if report:
+            errors = [abs(row[-1]) for row in report]
+            print("{} of {} shapes, mean error {:.2%}, max error {:.2%}".format(
+                len(report), len(shapes),
+                sum(errors) / len(errors), max(errors)))
+        else:
+            print("no results, Ramulator is not installed in {}".format(
+                args.ramulator))
+
+
+if __name__ == "__main__":
+    main()
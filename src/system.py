@@ -2,10 +2,38 @@ from .type import *
 from .model import *
 from .devices import *
 from .config import *
+import itertools
+import numpy as np
 RAMPATH = "./ramulator2"
 RAMLOG = "./ramulator.out"
 
 OPB_PRINT = False
+## generation stages costed together by the vectorized cost engine
+GEN_CHUNK = 1024
+
+
+def stage_weights(num_stages, stride=1, jitter=False):
+    # weights of the sampled generation stages, every stride-th stage and the
+    # last one. The stages between two samples are interpolated linearly, so
+    # the weights sum to num_stages and are all 1 for stride 1. With jitter,
+    # the stage of each stride is drawn (deterministically) from the ones
+    # between two regular samples, so that its offset in the piecewise-
+    # constant attention costs varies.
+    samples = list(range(0, num_stages, stride))
+    if jitter and stride > 1:
+        rng = np.random.default_rng(num_stages)
+        samples = [0] + [
+            stage for stage in (samples + rng.integers(1, stride, len(samples))
+                                ).tolist() if stage < num_stages - 1
+        ]
+    if samples[-1] != num_stages - 1:
+        samples.append(num_stages - 1)
+    weights = dict.fromkeys(samples, 0)
+    for a, b in zip(samples, samples[1:]):
+        weights[a] += (b - a + 1) / 2
+        weights[b] += (b - a - 1) / 2
+    weights[samples[-1]] += 1
+    return weights
 
 
 class System:
@@ -14,16 +42,22 @@ class System:
                  gpu_config,
                  modelinfos=None,
                  hetero_name: DeviceType = DeviceType.NONE,
-                 hetero_config=None):
+                 hetero_config=None,
+                 tile_table=None):
         scaling_factor = SCALING_FACTOR
         self.hetero_name = hetero_name
-        self.GPU = xPU(DeviceType.GPU, gpu_config, scaling_factor)
+        # file of the tiles found by the xPU cost model, None to keep them
+        # in memory only
+        self.tile_table = tile_table
+        self.GPU = xPU(DeviceType.GPU, gpu_config, scaling_factor,
+                       self.tile_table)
         self.AttDevice = self.GPU
         if self.hetero_name == DeviceType.PIM:
             self.AttDevice = PIM(hetero_config, scaling_factor)
 
         elif self.hetero_name == DeviceType.CPU:
-            self.AttDevice = xPU(DeviceType.CPU, hetero_config, scaling_factor)
+            self.AttDevice = xPU(DeviceType.CPU, hetero_config, scaling_factor,
+                                 self.tile_table)
 
         self.devices = {'GPU': self.GPU, 'Acc': self.AttDevice}
 
@@ -39,22 +73,25 @@ class System:
         self.model = Transformer(modelinfos, tensor_parallel=self.GPU.num_xpu)
         self.model_set = 1
 
-    def set_accelerator(self, modelinfos, name: DeviceType, config):
+    def set_accelerator(self, modelinfos, name: DeviceType, config,
+                        **ramulator_options):
         self.hetero_name = name
         if self.hetero_name == DeviceType.PIM:
-            ramulator = Ramulator(modelinfos, "ramulator2", "ramulator.out")
+            ramulator = Ramulator(modelinfos, "ramulator2", "ramulator.out",
+                                  **ramulator_options)
             self.devices['Acc'] = PIM(config,
                                       self.scaling_factor,
                                       ramulator)
 
         elif self.hetero_name == DeviceType.CPU:
             self.devices['Acc'] = xPU(DeviceType.CPU, config,
-                                      self.scaling_factor)
+                                      self.scaling_factor, self.tile_table)
 
     # Set all device to GPU
     def set_xpu(self, config):
         self.hetero_name = DeviceType.NONE
-        self.GPU = xPU(DeviceType.GPU, config, self.scaling_factor)
+        self.GPU = xPU(DeviceType.GPU, config, self.scaling_factor,
+                       self.tile_table)
         self.devices['GPU'] = self.GPU
         self.devices['Acc'] = self.GPU
         self.model.tp = self.GPU.num_xpu
@@ -67,7 +104,10 @@ class System:
                  pipe=False,
                  parallel_ff=False,
                  power_constraint=False,
-                 num_reqs=0):
+                 num_reqs=0,
+                 per_stage=False,
+                 stage_stride=1,
+                 stage_error=False):
 
         def add_infos(name, infos, time, energy, bound):
             new_name = name
@@ -186,9 +226,112 @@ class System:
                             attn_eff_bw)
                         layer.exec_time *= ratio
 
+        def _add_gen_energy(layer, weight=1):
+            energy = layer.energy
+            if weight != 1:
+                energy = [e * weight for e in energy]
+            if layer.type in gen_energies:
+                gen_energies[layer.type]['mem'] += energy[0]
+                gen_energies[layer.type]['comp'] += sum(energy[1:5])
+                gen_energies[layer.type]['comm'] += energy[5]
+            else:
+                gen_energies[layer.type] = {}
+                gen_energies[layer.type]['mem'] = energy[0]
+                gen_energies[layer.type]['comp'] = sum(energy[1:5])
+                gen_energies[layer.type]['comm'] = energy[5]
+
+            unit_energy['g_all'] += sum(energy)
+            unit_energy['g_offmem'] += energy[0]
+            unit_energy['g_l2'] += energy[1]
+            unit_energy['g_l1'] += energy[2]
+            unit_energy['g_reg'] += energy[3]
+            unit_energy['g_alu'] += energy[4]
+            unit_energy['g_comm'] += energy[5]
+
+        def _add_gen_perf(g_perf, layers, weight=1):
+            for layer in layers:
+                exec_time = layer.exec_time * weight
+                g_perf['all'] += exec_time
+                if layer.type == LayerType.FC:
+                    g_perf['fc'] += exec_time
+                    if 'ff' in layer.name:
+                        g_perf['ff'] += exec_time
+                    elif 'qkv' in layer.name:
+                        g_perf['qkv'] += exec_time
+                    elif 'proj' in layer.name:
+                        g_perf['prj'] += exec_time
+                elif layer.type == LayerType.MATMUL:
+                    g_perf['matmul'] += exec_time
+                elif layer.type in [LayerType.G2G, LayerType.X2G]:
+                    g_perf['comm'] += exec_time
+                    if 'x2g' in layer.name:
+                        g_perf['x2g'] += exec_time
+                    elif 'g2g' in layer.name:
+                        g_perf['g2g'] += exec_time
+                elif layer.type in [LayerType.ACT, LayerType.NORM]:
+                    g_perf['etc'] += exec_time
+                    if layer.type == LayerType.ACT:
+                        g_perf['act'] += exec_time
+                    elif layer.type == LayerType.NORM:
+                        g_perf['norm'] += exec_time
+                elif layer.type == LayerType.SOFTMAX:
+                    g_perf['softmax'] += exec_time
+
+        def _costed(gen_stage, layer):
+            # without per_stage, the layers shared by all stages are costed
+            # in the first one
+            return per_stage or gen_stage == 0 or layer.name in STAGE_LAYERS
+
+        def _gen_costs(layers):
+            # (exec_time, energy) of generation layers, one batch per device
+            costs = [None] * len(layers)
+            batches = {}
+            for i, layer in enumerate(layers):
+                if layer.type in [
+                        LayerType.MATMUL, LayerType.SOFTMAX, LayerType.X2G
+                ]:
+                    device = self.devices['Acc']
+                else:
+                    device = self.devices['GPU']
+                batches.setdefault(id(device), (device, []))[1].append(i)
+            for device, idxs in batches.values():
+                for i, cost in zip(
+                        idxs,
+                        device.get_times_and_energies(
+                            [layers[i] for i in idxs])):
+                    costs[i] = cost
+            return costs
+
         assert self.model_set, "Need to set_model"
-        self.model.build(batch_size, lin, lout, self.hetero_name
-                         in [DeviceType.CPU, DeviceType.PIM])
+        attn_on_hetero = self.hetero_name in [DeviceType.CPU, DeviceType.PIM]
+        num_stages = lout - 1
+        self.model.build_sum(batch_size, lin, attn_on_hetero)
+        g_block = None
+        if not per_stage:
+            # only the STAGE_LAYERS differ between the generation stages, the
+            # other layers of g_block are costed once and weighted by
+            # num_stages. per_stage builds and costs every stage instead.
+            g_block = self.model.gen_block(batch_size, lin, 1, attn_on_hetero)
+            g_invariant = [
+                layer for layer in g_block if layer.name not in STAGE_LAYERS
+            ]
+        # with stage_stride > 1, only every stage_stride-th stage (and the
+        # last one) is costed and the STAGE_LAYERS are integrated over the
+        # stages. With stage_error, the error is estimated against the
+        # integral over jittered samples of the same stride, which are costed
+        # as well but do not contribute to the results.
+        assert stage_stride >= 1, \
+            "stage_stride must be at least 1, got {}".format(stage_stride)
+        estimate_error = stage_error and stage_stride > 1
+        g_weights = stage_weights(num_stages, stage_stride)
+        check_weights = g_weights
+        if estimate_error:
+            check_weights = stage_weights(num_stages, stage_stride, True)
+        g_stages = [
+            gen_stage + 1 for gen_stage in sorted(
+                set(g_weights) | set(check_weights))
+        ]
+        self.num_sampled_stages = len(g_stages)
         second_batch_size = num_reqs % batch_size
         num_batches = 1
         target_bs = [batch_size]
@@ -218,7 +361,13 @@ class System:
             time = 0
             wrt_io_busy = 0
             s_decoder = self.model.sum_decoder
-            g_decoder = self.model.gen_decoder
+
+            if self.hetero_name == DeviceType.PIM:
+                # launch the Ramulator runs of all generation stages up front
+                self.devices['Acc'].prefetch(
+                    layer for block in self.model.gen_stages(
+                        batch_size, lin, lout, attn_on_hetero, g_block,
+                        g_stages) for layer in block)
 
             ## Summarization stage
             for layer in s_decoder:
@@ -237,51 +386,97 @@ class System:
                 time += exec_time
                 _opb_print(layer, 'sum')
 
+            g_perf = {
+                'all': 0,
+                'matmul': 0,
+                'fc': 0,
+                'comm': 0,
+                'etc': 0,
+                'qkv': 0,
+                'prj': 0,
+                'ff': 0,
+                'g2g': 0,
+                'x2g': 0,
+                'softmax': 0,
+                'act': 0,
+                'norm': 0
+            }
+
             ## Generation stage
-            for gen_stage, decoder_block in enumerate(g_decoder):
-                for l_idx, layer in enumerate(decoder_block):
-                    # Get execution time and energy
-                    if layer.type in [
-                            LayerType.MATMUL, LayerType.SOFTMAX, LayerType.X2G
-                    ]:
-                        exec_time, energy = self.devices[
-                            'Acc'].get_time_and_energy(layer)
+            # the stages are streamed, without per_stage they share the
+            # layers of g_block except for the STAGE_LAYERS
+            g_decoder = zip(
+                [stage - 1 for stage in g_stages],
+                self.model.gen_stages(batch_size, lin, lout, attn_on_hetero,
+                                      g_block, g_stages))
+            # time and energy of the stage-weighted layers of each stage
+            stage_costs = {}
+            # the stages are costed in chunks of GEN_CHUNK
+            while True:
+                chunk = list(itertools.islice(g_decoder, GEN_CHUNK))
+                if len(chunk) == 0:
+                    break
+                costs = iter(
+                    _gen_costs([
+                        layer for gen_stage, decoder_block in chunk
+                        for layer in decoder_block
+                        if _costed(gen_stage, layer)
+                    ]))
+                for gen_stage, decoder_block in chunk:
+                    stage_weight = g_weights.get(gen_stage, 0)
+                    stage_energy = 0
+                    for l_idx, layer in enumerate(decoder_block):
+                        if not _costed(gen_stage, layer):
+                            continue
+                        invariant = (not per_stage
+                                     and layer.name not in STAGE_LAYERS)
+                        weight = num_stages if invariant else stage_weight
+                        # Get execution time and energy
+                        exec_time, energy = next(costs)
+                        if not invariant:
+                            stage_energy += sum(energy)
+                        layer.exec_time = exec_time
+                        layer.energy = energy
+                        g_flops += layer.get_flops() * self.devices[
+                            'GPU'].num_xpu * weight
+                        time += exec_time * weight
+                        if gen_stage == 0:
+                            _opb_print(layer, 'gen')
+
+                        # energy
+                        _add_gen_energy(layer, weight)
+
+                    # pipeline
+                    if self.hetero_name == DeviceType.PIM:
+                        if not per_stage:
+                            # the pipeline overlaps qkv, proj and comm_x2g with
+                            # the attention of each stage, starting from their
+                            # costs in g_block
+                            if gen_stage == 0:
+                                base_times = [
+                                    layer.exec_time for layer in g_invariant
+                                ]
+                            for layer, exec_time in zip(
+                                    g_invariant, base_times):
+                                layer.exec_time = exec_time
+                        _pipeline(decoder_block, pipe)
+                        if parallel_ff:
+                            _ff_parallel(decoder_block)
+
+                    if per_stage or self.hetero_name == DeviceType.PIM:
+                        stage_block = decoder_block
                     else:
-                        exec_time, energy = self.devices[
-                            'GPU'].get_time_and_energy(layer)
-                    layer.exec_time = exec_time
-                    layer.energy = energy
-                    g_flops += layer.get_flops() * self.devices['GPU'].num_xpu
-                    time += exec_time
-                    if gen_stage == 0:
-                        _opb_print(layer, 'gen')
-
-                    # energy
-                    if layer.type in gen_energies:
-                        gen_energies[layer.type]['mem'] += layer.energy[0]
-                        gen_energies[layer.type]['comp'] += sum(
-                            layer.energy[1:5])
-                        gen_energies[layer.type]['comm'] += layer.energy[5]
-                    else:
-                        gen_energies[layer.type] = {}
-                        gen_energies[layer.type]['mem'] = layer.energy[0]
-                        gen_energies[layer.type]['comp'] = sum(
-                            layer.energy[1:5])
-                        gen_energies[layer.type]['comm'] = layer.energy[5]
-
-                    unit_energy['g_all'] += sum(layer.energy)
-                    unit_energy['g_offmem'] += layer.energy[0]
-                    unit_energy['g_l2'] += layer.energy[1]
-                    unit_energy['g_l1'] += layer.energy[2]
-                    unit_energy['g_reg'] += layer.energy[3]
-                    unit_energy['g_alu'] += layer.energy[4]
-                    unit_energy['g_comm'] += layer.energy[5]
-
-                # pipeline
-                if self.hetero_name == DeviceType.PIM:
-                    _pipeline(decoder_block, pipe)
-                    if parallel_ff:
-                        _ff_parallel(decoder_block)
+                        if gen_stage == 0:
+                            _add_gen_perf(g_perf, g_invariant, num_stages)
+                        stage_block = [
+                            layer for layer in decoder_block
+                            if layer.name in STAGE_LAYERS
+                        ]
+                    _add_gen_perf(g_perf, stage_block, stage_weight)
+                    if estimate_error:
+                        stage_costs[gen_stage] = (sum(
+                            layer.exec_time
+                            for layer in stage_block), stage_energy)
 
             s_perf = {
                 'all': 0,
@@ -313,50 +508,17 @@ class System:
                     s_perf['all'] += exec_time
                     s_perf['norm'] += exec_time
 
-            g_perf = {
-                'all': 0,
-                'matmul': 0,
-                'fc': 0,
-                'comm': 0,
-                'etc': 0,
-                'qkv': 0,
-                'prj': 0,
-                'ff': 0,
-                'g2g': 0,
-                'x2g': 0,
-                'softmax': 0,
-                'act': 0,
-                'norm': 0
-            }
-
-            for gen_stage, decoder_block in enumerate(g_decoder):
-                for l_idx, layer in enumerate(decoder_block):
-                    exec_time = layer.exec_time
-                    g_perf['all'] += exec_time
-                    if layer.type == LayerType.FC:
-                        g_perf['fc'] += exec_time
-                        if 'ff' in layer.name:
-                            g_perf['ff'] += exec_time
-                        elif 'qkv' in layer.name:
-                            g_perf['qkv'] += exec_time
-                        elif 'proj' in layer.name:
-                            g_perf['prj'] += exec_time
-                    elif layer.type == LayerType.MATMUL:
-                        g_perf['matmul'] += exec_time
-                    elif layer.type in [LayerType.G2G, LayerType.X2G]:
-                        g_perf['comm'] += exec_time
-                        if 'x2g' in layer.name:
-                            g_perf['x2g'] += exec_time
-                        elif 'g2g' in layer.name:
-                            g_perf['g2g'] += exec_time
-                    elif layer.type in [LayerType.ACT, LayerType.NORM]:
-                        g_perf['etc'] += exec_time
-                        if layer.type == LayerType.ACT:
-                            g_perf['act'] += exec_time
-                        elif layer.type == LayerType.NORM:
-                            g_perf['norm'] += exec_time
-                    elif layer.type == LayerType.SOFTMAX:
-                        g_perf['softmax'] += exec_time
+            # estimated error of the sampled stages, relative to the time and
+            # energy of the generation stages, None if not estimated
+            self.stage_error = [0, 0] if stage_stride == 1 else None
+            if estimate_error:
+                self.stage_error = [0, 0]
+                for i, total in enumerate(
+                    [g_perf['all'], unit_energy['g_all']]):
+                    diff = sum((g_weights.get(gen_stage, 0) -
+                                check_weights.get(gen_stage, 0)) * cost[i]
+                               for gen_stage, cost in stage_costs.items())
+                    self.stage_error[i] = abs(diff) / total
 
             g_perf = {k: v / (lout - 1) for k, v in g_perf.items()}
 
@@ -444,6 +606,34 @@ class System:
         else:
             perfs = [output]
 
+    def attention_energy(self, batch_size, lin, lout, stage_stride=1):
+        # [mem, comp, comm] energy of the PIM layers per generated token, in
+        # the units of simulate(). The attention energy follows from the
+        # command counts of the traces, so no Ramulator run is needed.
+        assert self.model_set, "Need to set_model"
+        assert self.hetero_name == DeviceType.PIM, "Need a PIM accelerator"
+        num_stages = lout - 1
+        device = self.devices['Acc']
+        energies = [0, 0, 0]
+
+        def add_energy(layers, weight):
+            for layer in layers:
+                energy = device.get_energy(layer)
+                energies[0] += energy[0] * weight
+                energies[1] += sum(energy[1:5]) * weight
+                energies[2] += energy[5] * weight
+
+        add_energy([
+            layer for layer in self.model.gen_block(batch_size, lin, 1, True)
+            if layer.type == LayerType.X2G
+        ], num_stages)
+        for gen_stage, weight in sorted(
+                stage_weights(num_stages, stage_stride).items()):
+            add_energy(
+                self.model.stage_layers(batch_size, lin, gen_stage + 1),
+                weight)
+        return [e / num_stages * self.model.ndec / 1000 for e in energies]
+
     def get_required_mem_capacity(self, batch_size, lin, lout):
         ndec = self.model.ndec
         hdim = self.model.hdim
@@ -0,0 +1,99 @@
+import collections
+import os
+
+import pytest
+
+from src.ramulator_wrapper import (COUNT_COLUMNS, LOG_COLUMNS, canonical_l,
+                                   check_log_counts, count_commands,
+                                   load_trace_generator, stale_tail_counts)
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TRACE_GEN = os.path.join(REPO, 'pim_ramulator_src', 'trace_gen')
+PIM_TYPES = {'BA': 'bank', 'BG': 'bg', 'BUFFER': 'buffer'}
+## trace commands counted in each of COUNT_COLUMNS
+TRACE_COMMANDS = [['PIM_MAC_AB', 'PIM_MAC_SB', 'PIM_MAC_PB'], ['PIM_SFM'],
+                  ['PIM_MV_GB'], ['PIM_MV_SB'], ['PIM_WR_GB']]
+
+
+def trace_counts(trace_file):
+    with open(trace_file) as f:
+        counter = collections.Counter(line.split()[0] for line in f)
+    return [sum(counter[c] for c in commands) for commands in TRACE_COMMANDS]
+
+
+def generate(tmp_path, pim_type_name, dhead, nhead, l, dbyte, vec=False):
+    # trace of the per-type generator, or of the vectorized one
+    trace_file = str(tmp_path / 'attacc.trace')
+    if vec:
+        generator = load_trace_generator(
+            os.path.join(TRACE_GEN, 'gen_trace_attacc_vec.py'))
+        generator.run_attention(PIM_TYPES[pim_type_name], dhead, nhead, l,
+                                trace_file, dbyte)
+    else:
+        generator = load_trace_generator(
+            os.path.join(
+                TRACE_GEN,
+                'gen_trace_attacc_{}.py'.format(PIM_TYPES[pim_type_name])))
+        generator.run_attention(dhead, nhead, l, trace_file, dbyte)
+    return trace_file
+
+
+# 16 and 48 heads per HBM take an odd number of 16-channel iterations, 40 a
+# partial last one
+@pytest.mark.parametrize('pim_type_name', list(PIM_TYPES))
+@pytest.mark.parametrize('nhead', [16, 32, 40, 48])
+@pytest.mark.parametrize('l', [1, 17, 99, 100, 300])
+def test_counts_match_generator(tmp_path, pim_type_name, nhead, l):
+    for dbyte in [1, 2]:
+        expected = count_commands(pim_type_name, 128, nhead, l, dbyte)
+        trace_file = generate(tmp_path, pim_type_name, 128, nhead, l, dbyte)
+        assert trace_counts(trace_file) == expected, dbyte
+        trace_file = generate(tmp_path, pim_type_name, 128, nhead, l, dbyte,
+                              vec=True)
+        assert trace_counts(trace_file) == expected, dbyte
+
+
+@pytest.mark.parametrize('pim_type_name', list(PIM_TYPES))
+def test_canonical_l(tmp_path, pim_type_name):
+    units = 2 if pim_type_name == 'BUFFER' else 16
+    for l in [1, 2, 3, 16, 17, 99, 100, 101]:
+        canonical = canonical_l(pim_type_name, l)
+        assert canonical % units == 0 and 0 <= canonical - l < units
+        assert count_commands(pim_type_name, 128, 48, l, 2) == \
+            count_commands(pim_type_name, 128, 48, canonical, 2)
+        # every L of a class has the same trace
+        with open(generate(tmp_path, pim_type_name, 128, 48, l, 2)) as f:
+            trace = f.read()
+        with open(generate(tmp_path, pim_type_name, 128, 48, canonical,
+                           2)) as f:
+            assert f.read() == trace, l
+
+
+@pytest.mark.parametrize('pim_type_name', list(PIM_TYPES))
+def test_stale_tail_counts(pim_type_name):
+    for nhead in [16, 32, 40, 48, 64]:
+        counts = count_commands(pim_type_name, 128, nhead, 100, 2)
+        stale = stale_tail_counts(pim_type_name, 128, nhead, 100, 2)
+        if (nhead + 15) // 16 % 2 == 0:
+            assert stale == counts, nhead
+        else:
+            # only the softmax and MVGB commands differ
+            assert stale[1] > counts[1] and stale[2] > counts[2], nhead
+            assert [stale[i] for i in [0, 3, 4]] == \
+                [counts[i] for i in [0, 3, 4]], nhead
+
+
+def test_check_log_counts(tmp_path):
+    output_log = str(tmp_path / 'ramulator.out')
+    counts = count_commands('BA', 128, 48, 100, 2)
+    stale = stale_tail_counts('BA', 128, 48, 100, 2)
+    wrong = [counts[0] + 1] + counts[1:]
+    with open(output_log, 'w') as f:
+        f.write(','.join(LOG_COLUMNS) + '\n')
+        for cycle, row_counts in enumerate([counts, stale, wrong]):
+            assert len(row_counts) == len(COUNT_COLUMNS)
+            row = [100, 48, 128, 2, 'BA', False, cycle] + row_counts + ['']
+            f.write(','.join(str(i) for i in row) + '\n')
+    num_rows, num_stale, mismatches = check_log_counts(output_log)
+    assert (num_rows, num_stale) == (3, 1)
+    assert [row.cycle for row in mismatches] == [2]
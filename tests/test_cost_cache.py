@@ -0,0 +1,95 @@
+from src.config import SCALING_FACTOR, make_model_config, make_xpu_config
+from src.devices import CostCache, xPU
+from src.model import Layer, Transformer
+from src.type import DataType, DeviceType, GPUType, LayerType
+
+
+def layers(batch=4, lin=512, stage=16):
+    # summarization and generation layers of a decoder, new objects per call
+    model = Transformer(make_model_config('GPT-175B', DataType.W16A16),
+                        tensor_parallel=8)
+    model.build_sum(batch, lin)
+    return model.sum_decoder + model.gen_block(batch, lin, stage)
+
+
+def device():
+    config = make_xpu_config(GPUType.A100a, num_gpu=8)['GPU']
+    return xPU(DeviceType.GPU, config, SCALING_FACTOR)
+
+
+def test_cached_layers_match_uncached():
+    uncached = device()
+    expected = []
+    for layer in layers():
+        exec_time, energy = uncached._time_and_energy(layer)
+        expected.append((exec_time, energy, [
+            getattr(layer, name, None)
+            for name in uncached._cost_attributes(layer)
+        ]))
+    # both bounds are restored
+    assert {attributes[0]
+            for _, _, attributes in expected if attributes} == \
+        {'compute', 'memory'}
+
+    for batched in [False, True]:
+        cached = device()
+        # misses, then hits on new layer objects
+        for hits in [False, True]:
+            start = cached.cost_cache.misses
+            batch = layers()
+            if batched:
+                costs = cached.get_times_and_energies(batch)
+            else:
+                costs = [cached.get_time_and_energy(layer) for layer in batch]
+            for layer, (exec_time, energy), (ref_time, ref_energy,
+                                             attributes) in zip(
+                                                 batch, costs, expected):
+                assert exec_time == ref_time, layer.name
+                assert energy == ref_energy, layer.name
+                assert [
+                    getattr(layer, name)
+                    for name in cached._cost_attributes(layer)
+                ] == attributes, layer.name
+            if hits:
+                assert cached.cost_cache.misses == start
+
+
+def test_lru_eviction():
+    cache = CostCache(lambda layer: ['bound'], size=2)
+    a, b, c = [
+        Layer('gen', 'qkv', LayerType.FC, True, DataType.W16A16, m, 64, 64, 1)
+        for m in [1, 2, 3]
+    ]
+    for layer in [a, b]:
+        cache.store(layer, layer.m, [layer.m])
+    assert cache.lookup(a) == (1, [1])
+    # b is the least recently used entry
+    cache.store(c, 3, [3])
+    assert cache.lookup(b) is None
+    assert cache.lookup(a) == (1, [1])
+    assert cache.lookup(c) == (3, [3])
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_key():
+    cache = CostCache(lambda layer: ['bound'])
+    layer = Layer('gen', 'act', LayerType.ACT, False, DataType.W16A16, 4, 64,
+                  1, 1)
+    layer.bound = 'memory'
+    cache.store(layer, 1.0, [1.0])
+    # the stage does not matter, the type, name and shape do
+    same = Layer('sum', 'act', LayerType.ACT, False, DataType.W16A16, 4, 64,
+                 1, 1)
+    assert cache.lookup(same) == (1.0, [1.0])
+    assert same.bound == 'memory'
+    for other in [
+            Layer('gen', 'glu', LayerType.ACT, False, DataType.W16A16, 4, 64,
+                  1, 1),
+            Layer('gen', 'act', LayerType.NORM, False, DataType.W16A16, 4, 64,
+                  1, 1),
+            Layer('gen', 'act', LayerType.ACT, False, DataType.W16A16, 4, 64,
+                  1, 2),
+            Layer('gen', 'act', LayerType.ACT, False, DataType.W8A8, 4, 64, 1,
+                  1)
+    ]:
+        assert cache.lookup(other) is None
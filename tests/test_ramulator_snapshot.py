@@ -0,0 +1,115 @@
+import os
+import shutil
+
+import pytest
+
+from src.ramulator_wrapper import (LOG_COLUMNS, VALUE_COLUMNS, Ramulator,
+                                   make_key, read_log, snapshot_path,
+                                   write_snapshot)
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODELINFOS = {'num_heads': 40, 'dhead': 128}
+BUILD_A = 'a' * 16
+BUILD_B = 'b' * 16
+
+
+def cache(output_log, provenance=None):
+    # with the provenance of the current build pinned
+    ramulator = Ramulator(MODELINFOS, 'ramulator2', output_log)
+    if provenance is not None:
+        for pim_type in ['BA', 'BG', 'BUFFER']:
+            for power_constraint in [False, True]:
+                ramulator.provenances[(pim_type,
+                                       power_constraint)] = provenance
+    return ramulator
+
+
+def load(output_log, provenance=None):
+    ramulator = cache(output_log, provenance)
+    ramulator.load()
+    return ramulator
+
+
+def reference(output_log, provenance=None):
+    # every row of the log passed to index_row() in order
+    ramulator = cache(output_log, provenance)
+    ramulator.loaded = True
+    for row in read_log(output_log).itertuples(index=False):
+        key = make_key(row.L, row.nhead, row.dhead, row.dbyte, row.pim_type,
+                       row.power_constraint)
+        ramulator.index_row(key, [int(getattr(row, c)) for c in VALUE_COLUMNS],
+                            row.provenance)
+    return ramulator
+
+
+def assert_lookups_agree(output_log, keys, provenance=None):
+    # lookups through the CSV and through the snapshot file agree with the
+    # rows selected by index_row()
+    expected = reference(output_log, provenance)
+    if os.path.exists(snapshot_path(output_log)):
+        os.remove(snapshot_path(output_log))
+    index = load(output_log, provenance)
+    write_snapshot(output_log)
+    snapshot = load(output_log, provenance)
+    for key in keys:
+        assert index.lookup(key) == expected.lookup(key), key
+        assert snapshot.lookup(key) == expected.lookup(key), key
+
+
+def write_log(path, rows):
+    with open(path, 'w') as f:
+        f.write(','.join(LOG_COLUMNS) + '\n')
+        for row in rows:
+            f.write(','.join(str(i) for i in row) + '\n')
+
+
+def log_row(l, cycle, provenance):
+    return [l, 40, 128, 2, 'BA', True, cycle, 1, 2, 3, 4, 5, provenance]
+
+
+def test_shipped_log(tmp_path):
+    log = os.path.join(REPO, 'ramulator.out')
+    if not os.path.exists(log):
+        pytest.skip('no ramulator.out')
+    output_log = str(tmp_path / 'ramulator.out')
+    shutil.copy(log, output_log)
+    keys = list(reference(output_log).index)
+    assert keys
+    assert_lookups_agree(output_log, keys)
+
+
+@pytest.mark.parametrize('provenance', [None, BUILD_A, BUILD_B])
+def test_provenances_and_tail(tmp_path, provenance):
+    output_log = str(tmp_path / 'ramulator.out')
+    write_log(output_log, [
+        log_row(1, 10, ''),
+        log_row(1, 11, BUILD_B),
+        log_row(1, 12, BUILD_A),
+        log_row(1, 13, ''),
+        log_row(1, 14, BUILD_A),
+        log_row(2, 20, BUILD_B),
+        log_row(2, 21, ''),
+        log_row(3, 30, BUILD_B),
+        log_row(4, 40, ''),
+    ])
+    keys = [(l, 40, 128, 2, 'BA', True) for l in range(1, 7)]
+    assert_lookups_agree(output_log, keys, provenance)
+
+    # rows appended after the snapshot, read from the CSV tail
+    with open(output_log, 'a') as f:
+        for row in [
+                log_row(1, 15, BUILD_A),
+                log_row(3, 31, ''),
+                log_row(3, 32, BUILD_A),
+                log_row(4, 41, BUILD_B),
+                log_row(5, 50, BUILD_A),
+                log_row(5, 51, ''),
+        ]:
+            f.write(','.join(str(i) for i in row) + '\n')
+    expected = reference(output_log, provenance)
+    snapshot = load(output_log, provenance)
+    os.remove(snapshot_path(output_log))
+    index = load(output_log, provenance)
+    for key in keys:
+        assert snapshot.lookup(key) == expected.lookup(key), key
+        assert index.lookup(key) == expected.lookup(key), key
@@ -0,0 +1,22 @@
+import pytest
+
+from bench.bench_tile_search import model_shapes, reference_tile
+from src.config import MODEL_TABLE, SCALING_FACTOR, make_xpu_config
+from src.devices import xPU
+from src.type import DataType, DeviceType, GPUType
+
+# (batch, lin, lout), shorter generations than the benchmark
+POINTS = [(1, 128, 32), (16, 2048, 32), (256, 2048, 32), (64, 8192, 2)]
+
+
+@pytest.mark.parametrize('name', list(MODEL_TABLE))
+@pytest.mark.parametrize('dtype', [DataType.W16A16, DataType.W8A8])
+@pytest.mark.parametrize('gpu', ['A100a', 'H100'])
+def test_optimal_tile(name, dtype, gpu):
+    # the vectorized tile search finds the tiles of the loops it replaced
+    config = make_xpu_config(GPUType[gpu], num_gpu=8)['GPU']
+    device = xPU(DeviceType.GPU, config, SCALING_FACTOR)
+    for shapes in model_shapes(name, dtype, 8, POINTS).values():
+        for shape in shapes:
+            assert device._optimal_tile(*shape) == \
+                reference_tile(device, *shape), shape
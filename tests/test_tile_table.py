@@ -0,0 +1,64 @@
+import pytest
+
+import src.devices
+from src.config import SCALING_FACTOR, make_model_config, make_xpu_config
+from src.devices import xPU
+from src.model import Transformer
+from src.type import DataType, DeviceType, GPUType, LayerType
+
+
+def gemm_layers(name, batch=4, lin=512):
+    # FC and MATMUL layers of a decoder, LLAMA-7B has non-integral shapes
+    model = Transformer(make_model_config(name, DataType.W16A16),
+                        tensor_parallel=8)
+    model.build_sum(batch, lin)
+    return [
+        layer for layer in model.sum_decoder +
+        model.gen_block(batch, lin, 16)
+        if layer.type in [LayerType.FC, LayerType.MATMUL]
+    ]
+
+
+def device(path):
+    config = make_xpu_config(GPUType.A100a, num_gpu=8)['GPU']
+    return xPU(DeviceType.GPU, config, SCALING_FACTOR, str(path))
+
+
+@pytest.fixture
+def tile_tables(monkeypatch):
+    # tables opened by the test only
+    monkeypatch.setattr(src.devices, 'TILE_TABLES', {})
+    return src.devices.TILE_TABLES
+
+
+def test_reopened_table(tmp_path, monkeypatch, tile_tables):
+    path = tmp_path / 'tiles.csv'
+    layers = gemm_layers('GPT-175B') + gemm_layers('LLAMA-7B')
+    writer = device(path)
+    expected = [writer._get_optimal_tile(layer) for layer in layers]
+    writer.tile_table.flush()
+    assert path.exists()
+
+    # a new process: the tiles are read from the file
+    tile_tables.clear()
+    reader = device(path)
+    searched = []
+
+    def optimal_tile(*shape):
+        searched.append(shape)
+        return writer._optimal_tile(*shape)
+
+    monkeypatch.setattr(reader, '_optimal_tile', optimal_tile)
+    assert [reader._get_optimal_tile(layer) for layer in layers] == expected
+    assert searched == []
+
+    # a shape missing in the table is searched once and appended
+    layer = gemm_layers('GPT-175B', batch=3)[0]
+    tile = reader._get_optimal_tile(layer)
+    assert reader._get_optimal_tile(layer) == tile
+    assert searched == [(layer.type, ) + layer.get_infos()]
+    reader.tile_table.flush()
+    tile_tables.clear()
+    assert device(path).tile_table.lookup(
+        (reader.num_core, reader.l1_cache_size, reader.l2_cache_size,
+         layer.type.name) + layer.get_infos()) == tile